@@ -0,0 +1,2 @@
+# Benchmarks of the DataOptimizer engines on generated trees, run with
+# python -m benchmarks.run from the repository root. See README.md.
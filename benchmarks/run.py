@@ -0,0 +1,208 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from benchmarks.synthetic_tree import DEFAULT_TREE_OPTIONS, SIZE_DISTRIBUTIONS, ensure_tree
+
+ENGINES = ("hash", "duplicates", "sizes", "similar_folders")
+
+RESULTS_VERSION = 1
+
+# Method to drop the page cache so the next run reads from disk. Needs root on
+# Linux; returns whether it worked.
+def drop_caches():
+    if not hasattr(os, "sync"):
+        return False
+    os.sync()
+    try:
+        with open("/proc/sys/vm/drop_caches", "w") as f:
+            f.write("3\n")
+        return True
+    except OSError:
+        return False
+
+# Method to get the peak resident set size of this process in bytes
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Benchmark of hashing every file with the hash engine; returns (files, bytes)
+def run_hash(tree, index_path):
+    from dataoptimizer.hashing import HashEngine
+    from dataoptimizer.scanner import scan_files
+
+    files = [(record.path, record.size) for record in scan_files(tree)]
+    for _ in HashEngine.for_path(tree).hash_files(files):
+        pass
+    return len(files), sum(size for _, size in files)
+
+# Benchmark of finding duplicates by hash with a file index; a warm run reuses
+# the index of the cold run
+def run_duplicates(tree, index_path):
+    from dataoptimizer.duplicates import DuplicateFinder
+    from dataoptimizer.index import FileIndex
+
+    index = FileIndex(index_path)
+    try:
+        duplicate_finder = DuplicateFinder(index=index)
+        duplicate_finder.scan(tree, ["hash"])
+    finally:
+        index.close()
+    stats = duplicate_finder.stage_stats
+    return stats["size"]["files"], stats["partial"]["bytes"] + stats["full"]["bytes"]
+
+# Benchmark of the size report; reads metadata only
+def run_sizes(tree, index_path):
+    from dataoptimizer.sizes import scan_sizes
+
+    report = scan_sizes(tree)
+    return report.file_count, 0
+
+# Benchmark of finding similar folders; reads metadata only and does not count
+# files, so the tree's file count is reported
+def run_similar_folders(tree, index_path):
+    from dataoptimizer.similarity import find_similar_folders
+
+    for _ in find_similar_folders(tree):
+        pass
+    return None, 0
+
+BENCHMARKS = {
+    "hash": run_hash,
+    "duplicates": run_duplicates,
+    "sizes": run_sizes,
+    "similar_folders": run_similar_folders,
+}
+
+# Method to time one benchmark in a fresh process, so the peak RSS belongs to
+# that run only. Sends the measurement back through the queue.
+def measure(engine, tree, index_path, file_count, queue):
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    files, read_bytes = BENCHMARKS[engine](tree, index_path)
+    seconds = time.perf_counter() - start_wall
+    if files is None:
+        files = file_count
+    queue.put({
+        "seconds": seconds,
+        "cpu_seconds": time.process_time() - start_cpu,
+        "files": files,
+        "bytes": read_bytes,
+        "files_per_second": files / seconds if seconds else None,
+        "mb_per_second": read_bytes / seconds / (1024 * 1024) if seconds and read_bytes else None,
+        "peak_rss_bytes": peak_rss(),
+    })
+
+# Method to run a benchmark in a spawned process and return its measurement
+def run_isolated(engine, tree, index_path, file_count):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(engine, tree, index_path, file_count, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Benchmark {engine} failed with exit code {process.exitcode}")
+    return queue.get()
+
+# Method to run every engine cold (empty page cache where possible, new file
+# index) and then warm, and return the results document
+def run_benchmarks(tree, tree_summary, engines=ENGINES, repeat=1):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="dataoptimizer-bench-") as work_dir:
+        for engine in engines:
+            index_path = os.path.join(work_dir, f"{engine}.sqlite3")
+            for mode in ("cold", "warm"):
+                for run in range(repeat if mode == "warm" else 1):
+                    cache_dropped = drop_caches() if mode == "cold" else False
+                    result = run_isolated(engine, tree, index_path, tree_summary["files"])
+                    results.append({"engine": engine, "mode": mode, "run": run, "cache_dropped": cache_dropped, **result})
+                    print(f"{engine:16} {mode:5} {result['seconds']:8.3f}s {result['files_per_second'] or 0:12.0f} files/s "
+                          f"{result['mb_per_second'] or 0:9.1f} MB/s {(result['peak_rss_bytes'] or 0) / (1024 * 1024):8.1f} MB RSS", file=sys.stderr)
+    return {
+        "version": RESULTS_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "tree": tree_summary,
+        "results": results,
+    }
+
+# Method to print the speedup of each engine and mode against an earlier results file
+def compare_results(results, baseline):
+    def best_times(document):
+        times = {}
+        for result in document["results"]:
+            key = (result["engine"], result["mode"])
+            times[key] = min(times.get(key, result["seconds"]), result["seconds"])
+        return times
+
+    if baseline["tree"]["options"] != results["tree"]["options"]:
+        print("Warning: the baseline was measured on a tree generated with other options", file=sys.stderr)
+    baseline_times = best_times(baseline)
+    for key, seconds in best_times(results).items():
+        if key in baseline_times:
+            print(f"{key[0]:16} {key[1]:5} {baseline_times[key]:8.3f}s -> {seconds:8.3f}s ({baseline_times[key] / seconds:.2f}x)", file=sys.stderr)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the DataOptimizer engines on a repeatable synthetic tree. Results are written as JSON.")
+    parser.add_argument("--tree", metavar="DIR", help="where to generate the tree, reused by later runs with the same options (default: a temporary folder)")
+    parser.add_argument("--engine", dest="engines", action="append", choices=ENGINES, help="engine to benchmark (repeatable, default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of warm runs per engine")
+    parser.add_argument("--output", metavar="FILE", help="file to write the results to (default: stdout)")
+    parser.add_argument("--compare", metavar="FILE", help="earlier results to print speedups against")
+    parser.add_argument("--files", type=int, default=DEFAULT_TREE_OPTIONS["files"])
+    parser.add_argument("--folders", type=int, default=DEFAULT_TREE_OPTIONS["folders"], help="number of top-level folders")
+    parser.add_argument("--depth", type=int, default=DEFAULT_TREE_OPTIONS["depth"], help="levels of subfolders in each top-level folder")
+    parser.add_argument("--fanout", type=int, default=DEFAULT_TREE_OPTIONS["fanout"], help="maximum number of subfolders per folder")
+    parser.add_argument("--size-distribution", choices=SIZE_DISTRIBUTIONS, default=DEFAULT_TREE_OPTIONS["size_distribution"])
+    parser.add_argument("--median-size", type=int, default=DEFAULT_TREE_OPTIONS["median_size"], help="median file size in bytes")
+    parser.add_argument("--max-size", type=int, default=DEFAULT_TREE_OPTIONS["max_size"], help="largest file size in bytes")
+    parser.add_argument("--duplicate-ratio", type=float, default=DEFAULT_TREE_OPTIONS["duplicate_ratio"], help="share of files that repeat an earlier file's content")
+    parser.add_argument("--similar-folder-ratio", type=float, default=DEFAULT_TREE_OPTIONS["similar_folder_ratio"], help="share of top-level folders that copy an earlier folder's structure")
+    parser.add_argument("--seed", type=int, default=DEFAULT_TREE_OPTIONS["seed"])
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    tree_options = {name: getattr(args, name) for name in DEFAULT_TREE_OPTIONS}
+    tree = args.tree or tempfile.mkdtemp(prefix="dataoptimizer-tree-")
+    try:
+        print(f"Generating tree in {tree}", file=sys.stderr)
+        tree_summary = ensure_tree(tree, **tree_options)
+        results = run_benchmarks(tree, tree_summary, args.engines or ENGINES, args.repeat)
+    finally:
+        if not args.tree:
+            shutil.rmtree(tree, ignore_errors=True)
+            try:
+                os.remove(os.path.normpath(tree) + ".json")
+            except OSError:
+                pass
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(results, json.load(f))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
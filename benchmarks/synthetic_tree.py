@@ -0,0 +1,133 @@
+import json
+import math
+import os
+import random
+
+# Size distributions of generated files
+SIZE_DISTRIBUTIONS = ("lognormal", "uniform", "fixed")
+
+# Parameters of a generated tree, see generate_tree
+DEFAULT_TREE_OPTIONS = {
+    "files": 10000,
+    "folders": 50,
+    "depth": 3,
+    "fanout": 3,
+    "size_distribution": "lognormal",
+    "median_size": 16 * 1024,
+    "max_size": 64 * 1024 * 1024,
+    "duplicate_ratio": 0.2,
+    "similar_folder_ratio": 0.2,
+    "seed": 0,
+}
+
+# Share of the subfolders left out of a similar copy of a folder, so copies are
+# similar but not identical
+SIMILAR_FOLDER_DROP = 0.1
+
+# Method to draw a file size from the given distribution
+def draw_size(rng, distribution, median_size, max_size):
+    if distribution == "fixed":
+        return median_size
+    if distribution == "uniform":
+        return rng.randint(0, 2 * median_size)
+    # Few large and many small files, like most real trees
+    return min(max_size, int(rng.lognormvariate(math.log(median_size), 1.5)))
+
+# Method to build the relative subfolders of one top-level folder, parents first
+def random_structure(rng, depth, fanout):
+    structure = []
+    parents = [""]
+    for level in range(depth):
+        children = []
+        for parent in parents:
+            for i in range(rng.randint(1, fanout)):
+                children.append(os.path.join(parent, f"sub{level}_{i}"))
+        structure.extend(children)
+        parents = children
+    return structure
+
+# Method to list the parent paths of a relative path
+def parent_paths(path):
+    parents = []
+    parent = os.path.dirname(path)
+    while parent:
+        parents.append(parent)
+        parent = os.path.dirname(parent)
+    return parents
+
+# Method to generate a repeatable tree below root. The same options always give
+# the same folders, names and contents. Folders come as top-level folders with
+# random subfolders, a share of them copies the structure of an earlier folder
+# (see find_similar_folders), and a share of the files repeat the content of an
+# earlier file. Returns a summary of what was generated.
+def generate_tree(root, **options):
+    options = {**DEFAULT_TREE_OPTIONS, **options}
+    if options["size_distribution"] not in SIZE_DISTRIBUTIONS:
+        raise ValueError(f"Unknown size distribution {options['size_distribution']!r}, choose one of {', '.join(SIZE_DISTRIBUTIONS)}")
+    rng = random.Random(options["seed"])
+
+    directories = []
+    structures = []
+    similar_folders = 0
+    for i in range(options["folders"]):
+        if structures and rng.random() < options["similar_folder_ratio"]:
+            source = rng.choice(structures)
+            structure = [path for path in source if rng.random() >= SIMILAR_FOLDER_DROP]
+            # Keep parents of every kept subfolder
+            kept = set(structure)
+            structure = [path for path in structure if all(parent in kept for parent in parent_paths(path))]
+            similar_folders += 1
+        else:
+            structure = random_structure(rng, options["depth"], options["fanout"])
+        structures.append(structure)
+        top_folder = f"folder{i:04d}"
+        directories.append(top_folder)
+        directories.extend(os.path.join(top_folder, path) for path in structure)
+
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    # Contents are kept as (seed, size) and generated when written, so
+    # duplicates of large files do not have to be held in memory
+    contents = []
+    duplicates = 0
+    total_bytes = 0
+    for i in range(options["files"]):
+        if contents and rng.random() < options["duplicate_ratio"]:
+            content_seed, size = rng.choice(contents)
+            duplicates += 1
+        else:
+            content_seed, size = rng.getrandbits(64), draw_size(rng, options["size_distribution"], options["median_size"], options["max_size"])
+            contents.append((content_seed, size))
+        path = os.path.join(root, rng.choice(directories), f"file{i:07d}.bin")
+        with open(path, "wb") as file:
+            file.write(random.Random(content_seed).randbytes(size))
+        total_bytes += size
+
+    return {
+        "options": options,
+        "directories": len(directories),
+        "files": options["files"],
+        "bytes": total_bytes,
+        "duplicates": duplicates,
+        "similar_folders": similar_folders,
+    }
+
+# Method to reuse a tree generated earlier with the same options, or generate it.
+# The summary is kept next to the tree, not in it, so it is never scanned.
+def ensure_tree(root, **options):
+    options = {**DEFAULT_TREE_OPTIONS, **options}
+    summary_path = os.path.normpath(root) + ".json"
+    try:
+        with open(summary_path) as f:
+            summary = json.load(f)
+        if summary["options"] == options and os.path.isdir(root):
+            return summary
+    except (OSError, ValueError, KeyError):
+        pass
+    if os.path.exists(root) and os.listdir(root):
+        raise ValueError(f"{root} is not empty and was not generated with these options")
+    summary = generate_tree(root, **options)
+    with open(summary_path, "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
@@ -0,0 +1,52 @@
+# GUI-free core of DataOptimizer. Submodules are imported on first use, so
+# importing the package (or running the CLI) only loads what is needed.
+import importlib
+
+_EXPORTS = {
+    "compress_files": "compression",
+    "DuplicateFinder": "duplicates",
+    "FileTable": "filetable",
+    "calculate_similarity_percentage": "folders",
+    "compare_folder_structures": "folders",
+    "create_folders": "folders",
+    "is_folder_count_similar": "folders",
+    "map_folder_structure": "folders",
+    "map_folder_structures": "folders",
+    "describe_merge_event": "merging",
+    "execute_merge": "merging",
+    "merge_folders": "merging",
+    "plan_merge": "merging",
+    "HASH_ALGORITHMS": "hashing",
+    "HashEngine": "hashing",
+    "detect_storage_type": "hashing",
+    "hash_file": "hashing",
+    "hash_file_partial": "hashing",
+    "FileIndex": "index",
+    "default_index_path": "index",
+    "Job": "jobs",
+    "JobCancelled": "jobs",
+    "choose_keeper": "linking",
+    "link_duplicates": "linking",
+    "FileRecord": "scanner",
+    "scan_files": "scanner",
+    "tune_concurrency": "scanner",
+    "walk": "scanner",
+    "merge_shards": "shards",
+    "read_shard": "shards",
+    "write_shard": "shards",
+    "write_shards": "shards",
+    "find_similar_folders": "similarity",
+    "minhash_signature": "similarity",
+    "SizeReport": "sizes",
+    "scan_sizes": "sizes",
+    "IndexWatcher": "watcher",
+}
+
+__all__ = sorted(_EXPORTS)
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{_EXPORTS[name]}", __name__), name)
+    globals()[name] = value
+    return value
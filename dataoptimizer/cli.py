@@ -0,0 +1,348 @@
+import argparse
+import json
+import os
+import sys
+
+# Method to write a result as a single JSON line
+def emit(record, stream=None):
+    (stream or sys.stdout).write(json.dumps(record) + "\n")
+
+# Method to report a scan error on stderr without stopping the scan
+def report_error(e):
+    emit({"error": str(e)}, sys.stderr)
+
+def add_scan_arguments(parser):
+    parser.add_argument("--include", action="append", metavar="GLOB", help="only scan files matching the pattern (repeatable)")
+    parser.add_argument("--exclude", action="append", metavar="GLOB", help="skip files and folders matching the pattern (repeatable)")
+    parser.add_argument("--max-depth", type=int, help="do not enter folders deeper than this below the path")
+    parser.add_argument("--follow-symlinks", action="store_true", help="follow symlinks instead of skipping them")
+    parser.add_argument("--concurrency", type=int, metavar="N", help="list folders and stat files N at a time, e.g. on NFS or SMB (default: tuned per mount, 1 on local disks)")
+
+def scan_options(args):
+    return {
+        "include": args.include,
+        "exclude": args.exclude,
+        "max_depth": args.max_depth,
+        "follow_symlinks": args.follow_symlinks,
+        "concurrency": args.concurrency,
+        "onerror": report_error,
+    }
+
+def create_engine(args):
+    from .hashing import HashEngine
+
+    engine_options = {"workers": args.workers, "use_processes": args.processes, "algorithm": args.algorithm}
+    if args.storage == "auto":
+        return HashEngine.for_path(args.path, **engine_options)
+    return HashEngine(storage=args.storage, **engine_options)
+
+# Method to answer from the file index kept by "watch" or earlier scans, without walking the folder
+def run_dedup_from_index(args):
+    from .index import FileIndex
+
+    index = FileIndex(args.index)
+    try:
+        groups = index.duplicate_groups(args.path, args.algorithm)
+    finally:
+        index.close()
+    for full_hash, paths in groups.items():
+        emit({"method": "hash", "key": full_hash, "paths": paths})
+
+def run_dedup(args):
+    from .duplicates import DuplicateFinder
+
+    if args.from_index:
+        run_dedup_from_index(args)
+        return
+    engine = create_engine(args)
+
+    index = None
+    if not args.no_index:
+        from .index import FileIndex
+        index = FileIndex(args.index)
+
+    duplicate_finder = DuplicateFinder(engine, index, metrics=args.metrics)
+    try:
+        duplicate_finder.scan(args.path, args.methods, **scan_options(args))
+    finally:
+        if index:
+            index.close()
+
+    for method, file_key, paths in duplicate_finder.iter_duplicates(args.methods):
+        if method == "tree":
+            total_size, file_count = duplicate_finder.tree_sizes[file_key]
+            emit({"method": method, "key": file_key, "paths": paths, "size": total_size, "files": file_count})
+        else:
+            emit({"method": method, "key": file_key, "paths": paths})
+    if args.stats:
+        emit({"stage_stats": duplicate_finder.stage_stats}, sys.stderr)
+
+    if args.link:
+        from .linking import link_duplicates
+
+        # Groups are built one at a time while linking
+        groups = (paths for _, _, paths in duplicate_finder.iter_duplicates(["hash"]))
+        reclaimed = 0
+        for event in link_duplicates(groups, args.keep, args.prefer, args.link):
+            emit(event)
+            reclaimed += event.get("reclaimed", 0)
+        emit({"reclaimed": reclaimed})
+
+def run_sizes(args):
+    if args.from_index:
+        from .index import FileIndex
+
+        index = FileIndex(args.index)
+        try:
+            for path, size in index.largest_files(args.path, args.top):
+                emit({"path": path, "size": size})
+        finally:
+            index.close()
+        return
+    if not (args.top or args.histogram or args.directories):
+        from .scanner import scan_files
+
+        for record in scan_files(args.path, metrics=args.metrics, **scan_options(args)):
+            emit({"path": record.path, "size": record.size})
+        return
+
+    from .sizes import DEFAULT_TOP_K, scan_sizes
+
+    report = scan_sizes(args.path, args.top or DEFAULT_TOP_K, metrics=args.metrics, **scan_options(args))
+    if args.top:
+        for path, size in report.largest_files():
+            emit({"path": path, "size": size})
+    if args.histogram:
+        for low, high, file_count, total_size in report.histogram():
+            emit({"bucket": [low, high], "files": file_count, "size": total_size})
+    if args.directories:
+        for path, size in report.directory_totals():
+            emit({"directory": path, "size": size})
+
+def run_similar_folders(args):
+    from .similarity import find_similar_folders
+
+    for group in find_similar_folders(args.path, args.threshold, include_files=args.files, include_sizes=args.sizes, metrics=args.metrics, recall=args.recall, **scan_options(args)):
+        emit({"folders": group})
+
+def run_merge(args):
+    from .merging import merge_folders, plan_merge
+
+    for folder in args.folders:
+        try:
+            if args.dry_run:
+                plan = plan_merge(args.primary, folder, onerror=report_error, metrics=args.metrics, remove_identical=args.remove_identical, journal_path=args.journal)
+                for entry in plan.entries:
+                    emit({"action": entry.action, "source": plan.source(entry), "destination": plan.destination(entry), "size": entry.size})
+                emit({"primary": args.primary, "folder": folder, "summary": plan.summary()})
+                continue
+            for event in merge_folders(args.primary, folder, args.workers, args.journal, args.metrics, args.remove_identical):
+                emit(event)
+        except ValueError as e:
+            report_error(e)
+
+def run_compress(args):
+    from .compression import compress_files
+    from .scanner import scan_files
+
+    def expand(paths):
+        for path in paths:
+            if os.path.isdir(path):
+                yield from (record.path for record in scan_files(path, metrics=args.metrics, **scan_options(args)))
+            else:
+                yield path
+
+    files = list(expand(args.files))
+    for entry in compress_files(files, args.output, args.base, args.codec, args.level, args.workers, onerror=report_error, metrics=args.metrics):
+        emit(entry)
+
+def run_watch(args):
+    from .index import FileIndex
+    from .watcher import IndexWatcher
+
+    # Events come rarely and are read as they happen, so each line is flushed
+    def onevent(event):
+        emit(event)
+        sys.stdout.flush()
+
+    index = FileIndex(args.index)
+    watcher = IndexWatcher(args.path, index, create_engine(args), args.debounce, args.rescan_interval,
+                           include=args.include, exclude=args.exclude, onevent=onevent, onerror=report_error)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        index.close()
+
+def run_shard(args):
+    from .shards import write_shards
+
+    engine_options = {"workers": args.workers, "use_processes": args.processes, "algorithm": args.algorithm}
+    if args.storage != "auto":
+        engine_options["storage"] = args.storage
+    for header in write_shards(args.paths, args.output, args.host, not args.no_index, args.index, args.min_size, engine_options, args.metrics, **scan_options(args)):
+        emit(header)
+
+def run_merge_shards(args):
+    from .shards import merge_shards
+
+    groups = 0
+    duplicate_bytes = 0
+    try:
+        for group in merge_shards(args.shards):
+            emit(group)
+            groups += 1
+            duplicate_bytes += group["size"] * (len(group["files"]) - 1)
+    except ValueError as e:
+        report_error(e)
+        sys.exit(1)
+    emit({"groups": groups, "duplicate_bytes": duplicate_bytes})
+
+def run_mkdirs(args):
+    from .folders import create_folders
+
+    names = args.names or [line for line in sys.stdin.read().split("\n") if line.strip()]
+    for folder_path in create_folders(args.base_path, names):
+        emit({"created": folder_path})
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="dataoptimizer", description="Find duplicates, analyze file sizes and merge similar folders. Results are written as JSON Lines.")
+    parser.add_argument("--metrics", metavar="FILE", dest="metrics_file", help="write per-phase timings and counters to FILE when done, as Prometheus text if it ends in .prom, else as JSON")
+    parser.add_argument("--profile", metavar="FILE", help="profile the run with cProfile and write the stats to FILE")
+    parser.add_argument("--trace-memory", action="store_true", help="with --profile, also write the largest allocation sites to FILE.memory.txt")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    dedup = subparsers.add_parser("dedup", help="find duplicate files")
+    dedup.add_argument("path")
+    dedup.add_argument("--method", dest="methods", action="append", choices=["hash", "size", "name", "date", "tree"], help="method to compare files by, tree finds identical folders (repeatable, default: hash)")
+    dedup.add_argument("--storage", choices=["auto", "ssd", "hdd"], default="auto", help="storage type to pick hashing defaults for")
+    dedup.add_argument("--workers", type=int, help="number of hashing workers")
+    dedup.add_argument("--algorithm", choices=["blake2b", "sha256", "md5"], default="blake2b", help="hash algorithm to compare file contents with (default: blake2b)")
+    dedup.add_argument("--processes", action="store_true", help="hash on a process pool instead of threads")
+    dedup.add_argument("--index", metavar="FILE", help="file index to use instead of the default one")
+    dedup.add_argument("--no-index", action="store_true", help="do not read or update the file index")
+    dedup.add_argument("--from-index", action="store_true", help="list duplicates by hash as recorded in the file index (e.g. by watch) instead of scanning")
+    dedup.add_argument("--link", choices=["auto", "reflink", "hardlink"], help="replace duplicates found by hash with links to one kept copy, auto prefers reflinks")
+    dedup.add_argument("--keep", choices=["oldest", "shortest"], default="oldest", help="which copy of a duplicate group to keep with --link (default: oldest)")
+    dedup.add_argument("--prefer", metavar="FOLDER", help="keep copies below this folder with --link, before applying --keep")
+    dedup.add_argument("--stats", action="store_true", help="write per-stage statistics to stderr")
+    add_scan_arguments(dedup)
+    dedup.set_defaults(func=run_dedup)
+
+    sizes = subparsers.add_parser("sizes", help="list files with their sizes")
+    sizes.add_argument("path")
+    sizes.add_argument("--top", type=int, metavar="N", help="only list the N largest files, largest first")
+    sizes.add_argument("--histogram", action="store_true", help="list file counts and sizes per power-of-two size bucket")
+    sizes.add_argument("--directories", action="store_true", help="list the total size of every folder, largest first")
+    sizes.add_argument("--from-index", action="store_true", help="with --top, answer from the file index (e.g. kept by watch) instead of scanning")
+    sizes.add_argument("--index", metavar="FILE", help="file index to use with --from-index instead of the default one")
+    add_scan_arguments(sizes)
+    sizes.set_defaults(func=run_sizes)
+
+    similar_folders = subparsers.add_parser("similar-folders", help="find subfolders with a similar structure")
+    similar_folders.add_argument("path")
+    similar_folders.add_argument("--threshold", type=float, default=60, help="minimum percentage of matching subfolders (default: 60)")
+    similar_folders.add_argument("--recall", type=float, default=0.95, help="probability with which a pair just at the threshold is found; the search is approximate and higher values check more candidates (default: 0.95)")
+    similar_folders.add_argument("--files", action="store_true", help="compare file names as well as subfolders")
+    similar_folders.add_argument("--sizes", action="store_true", help="with --files, only count files as matching if their sizes match too")
+    add_scan_arguments(similar_folders)
+    similar_folders.set_defaults(func=run_similar_folders)
+
+    merge = subparsers.add_parser("merge", help="move the contents of folders into a primary folder")
+    merge.add_argument("primary")
+    merge.add_argument("folders", nargs="+")
+    merge.add_argument("--dry-run", action="store_true", help="only print the plan and a summary of each merge")
+    merge.add_argument("--workers", type=int, help="number of files moved or copied in parallel")
+    merge.add_argument("--remove-identical", action="store_true", help="remove files that already exist in the primary folder with the same content, instead of leaving them in place")
+    merge.add_argument("--journal", metavar="FILE", help="journal to resume an interrupted merge from (single folder only)")
+    merge.set_defaults(func=run_merge)
+
+    compress = subparsers.add_parser("compress", help="compress files and folders into a ZIP archive")
+    compress.add_argument("output", help="path of the ZIP archive to write")
+    compress.add_argument("files", nargs="+", help="files or folders to add")
+    compress.add_argument("--base", help="folder the names in the archive are relative to (default: common folder of the files)")
+    compress.add_argument("--codec", choices=["deflate", "bz2", "lzma", "store"], default="deflate")
+    compress.add_argument("--level", type=int, help="compression level of the codec")
+    compress.add_argument("--workers", type=int, help="number of compression workers")
+    add_scan_arguments(compress)
+    compress.set_defaults(func=run_compress)
+
+    shard = subparsers.add_parser("shard", help="write a mergeable shard of file sizes and hashes per folder, see merge-shards")
+    shard.add_argument("paths", nargs="+", help="folders to scan, in parallel (e.g. one per disk)")
+    shard.add_argument("--output", required=True, metavar="DIR", help="folder to write the shards to, one per scanned folder")
+    shard.add_argument("--host", help="host name to record in the shards (default: this host's name)")
+    shard.add_argument("--min-size", type=int, default=0, metavar="BYTES", help="leave out files smaller than this")
+    shard.add_argument("--storage", choices=["auto", "ssd", "hdd"], default="auto", help="storage type to pick hashing defaults for")
+    shard.add_argument("--workers", type=int, help="number of hashing workers per folder")
+    shard.add_argument("--algorithm", choices=["blake2b", "sha256", "md5"], default="blake2b", help="hash algorithm, must be the same for all shards that are merged (default: blake2b)")
+    shard.add_argument("--processes", action="store_true", help="hash on a process pool instead of threads")
+    shard.add_argument("--index", metavar="FILE", help="file index to use instead of the default one")
+    shard.add_argument("--no-index", action="store_true", help="do not read or update the file index")
+    add_scan_arguments(shard)
+    shard.set_defaults(func=run_shard)
+
+    merge_shards = subparsers.add_parser("merge-shards", help="find duplicates across shards written by shard, e.g. on several hosts")
+    merge_shards.add_argument("shards", nargs="+", help="shard files to merge")
+    merge_shards.set_defaults(func=run_merge_shards)
+
+    watch = subparsers.add_parser("watch", help="keep the file index of a folder up to date until interrupted")
+    watch.add_argument("path")
+    watch.add_argument("--index", metavar="FILE", help="file index to keep up to date instead of the default one")
+    watch.add_argument("--debounce", type=float, default=2.0, help="seconds without changes before they are processed (default: 2)")
+    watch.add_argument("--rescan-interval", type=float, default=300.0, help="seconds between rescans where inotify is not available (default: 300)")
+    watch.add_argument("--storage", choices=["auto", "ssd", "hdd"], default="auto", help="storage type to pick hashing defaults for")
+    watch.add_argument("--workers", type=int, help="number of hashing workers")
+    watch.add_argument("--algorithm", choices=["blake2b", "sha256", "md5"], default="blake2b", help="hash algorithm to compare file contents with (default: blake2b)")
+    watch.add_argument("--processes", action="store_true", help="hash on a process pool instead of threads")
+    watch.add_argument("--include", action="append", metavar="GLOB", help="only index files matching the pattern (repeatable)")
+    watch.add_argument("--exclude", action="append", metavar="GLOB", help="skip files and folders matching the pattern (repeatable)")
+    watch.set_defaults(func=run_watch)
+
+    mkdirs = subparsers.add_parser("mkdirs", help="create folders below a base path")
+    mkdirs.add_argument("base_path")
+    mkdirs.add_argument("names", nargs="*", help="folders to create, read from stdin (one per line) if not given")
+    mkdirs.set_defaults(func=run_mkdirs)
+
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command == "dedup" and not args.methods:
+        args.methods = ["hash"]
+    if args.command == "merge" and args.journal and len(args.folders) > 1:
+        parser.error("--journal can only be used when merging a single folder")
+    if args.command == "sizes" and args.from_index and not args.top:
+        parser.error("--from-index needs --top")
+    if args.command == "dedup" and args.link and not {"hash", "tree"} & set(args.methods):
+        parser.error("--link needs --method hash, duplicates found by size, name or date are not verified")
+    if args.command == "similar-folders" and not 0 < args.recall <= 1:
+        parser.error("--recall must be above 0 and at most 1")
+    args.metrics = None
+    if args.metrics_file:
+        from .metrics import Metrics
+        args.metrics = Metrics()
+    try:
+        if args.profile:
+            from .metrics import profiled
+            with profiled(args.profile, args.trace_memory):
+                args.func(args)
+        else:
+            args.func(args)
+        sys.stdout.flush()
+    except KeyboardInterrupt:
+        return 130
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into head); silence the flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if args.metrics:
+            write_metrics(args.metrics, args.metrics_file)
+    return 0
+
+# Method to write metrics to a file, in the format given by its extension
+def write_metrics(metrics, path):
+    with open(path, "w") as f:
+        f.write(metrics.to_prometheus() if path.endswith(".prom") else metrics.to_json())
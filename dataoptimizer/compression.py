@@ -0,0 +1,285 @@
+import bz2
+import lzma
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# ZIP compression methods per codec name
+CODECS = {"store": 0, "deflate": 8, "bz2": 12, "lzma": 14}
+
+# Minimum ZIP version needed to extract per compression method
+METHOD_VERSIONS = {0: 20, 8: 20, 12: 46, 14: 63}
+ZIP64_VERSION = 45
+ZIP64_LIMIT = 0xFFFFFFFF
+# Value of a size or offset field whose real value is in the ZIP64 extra field
+ZIP64_MARKER = 0xFFFFFFFF
+
+# Extensions of formats that are already compressed and are stored as they are
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".7z", ".aac", ".avi", ".bz2", ".docx", ".flac", ".gif", ".gz", ".heic", ".jar",
+    ".jpeg", ".jpg", ".m4a", ".mkv", ".mov", ".mp3", ".mp4", ".odt", ".ogg", ".png",
+    ".pptx", ".rar", ".tgz", ".webm", ".webp", ".xlsx", ".xz", ".zip", ".zst",
+}
+
+# Size of the sample used to decide whether a file is worth compressing, and
+# the compressed/original ratio above which it is stored instead
+SAMPLE_SIZE = 64 * 1024
+MAX_SAMPLE_RATIO = 0.9
+
+# Size of a single read while compressing
+READ_SIZE = 1024 * 1024
+
+# Compressed data up to this size stays in memory, larger entries spill to a temporary file
+SPOOL_MEMORY = 8 * 1024 * 1024
+
+# Dictionary size per LZMA preset, needed to write the properties into the ZIP entry
+LZMA_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+
+# Method to create a compressor for a ZIP method. Returns the compressor and the
+# bytes that start the entry's data.
+def create_compressor(method, level=None):
+    if method == 8:
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, -15), b""
+    if method == 12:
+        return bz2.BZ2Compressor(9 if level is None else level), b""
+    preset = 6 if level is None else level
+    dict_size = LZMA_DICT_SIZES[preset]
+    compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[{"id": lzma.FILTER_LZMA1, "preset": preset, "dict_size": dict_size, "lc": 3, "lp": 0, "pb": 2}])
+    # LZMA SDK version, size of the properties, then lc/lp/pb and the dictionary size
+    properties = bytes([(2 * 5 + 0) * 9 + 3]) + struct.pack("<I", dict_size)
+    return compressor, struct.pack("<BBH", 9, 4, len(properties)) + properties
+
+# Method to check whether compressing a file is likely to save space, from its
+# extension and from how well a sample from its start compresses
+def is_compressible(path, sample):
+    if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) <= MAX_SAMPLE_RATIO * len(sample)
+
+# Class for the result of preparing one archive entry on a worker thread.
+# spool holds the compressed data, or is None if the file should be stored.
+class PreparedEntry:
+    def __init__(self, method, crc=0, compressed_size=0, size=0, spool=None):
+        self.method = method
+        self.crc = crc
+        self.compressed_size = compressed_size
+        self.size = size
+        self.spool = spool
+
+# Method to compress a file into a spool on a worker thread. Files that do not
+# compress well are left to be copied as they are by the writer.
+def prepare_entry(path, method, level=None):
+    if method == 0:
+        return PreparedEntry(0)
+    with open(path, "rb") as file:
+        chunk = file.read(SAMPLE_SIZE)
+        if not is_compressible(path, chunk):
+            return PreparedEntry(0)
+
+        compressor, header = create_compressor(method, level)
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY)
+        spool.write(header)
+        crc = 0
+        size = 0
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            spool.write(compressor.compress(chunk))
+            chunk = file.read(READ_SIZE)
+        spool.write(compressor.flush())
+    compressed_size = spool.tell()
+    spool.seek(0)
+    return PreparedEntry(method, crc, compressed_size, size, spool)
+
+# Method to convert a timestamp to the DOS date and time used by ZIP
+def dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    year = min(max(t.tm_year, 1980), 2107)
+    return ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday, (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+
+# Class to write a ZIP archive entry by entry to a seekable file. Entries are
+# written from already compressed data or copied from a file, with ZIP64
+# records added where sizes, offsets or the entry count need them.
+class ZipStreamWriter:
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.entries = []
+
+    def local_header(self, entry):
+        flags = 0x0800 if entry["utf8"] else 0
+        if entry["method"] == 14:
+            # The LZMA stream ends with an end-of-stream marker
+            flags |= 0x0002
+        extra = b""
+        compressed_size, size = entry["compressed_size"], entry["size"]
+        if entry["zip64"]:
+            extra = struct.pack("<HHQQ", 0x0001, 16, size, compressed_size)
+            compressed_size = size = ZIP64_MARKER
+        return struct.pack(
+            "<4sHHHHHIIIHH", b"PK\x03\x04", entry["version"], flags, entry["method"],
+            entry["time"], entry["date"], entry["crc"], compressed_size, size,
+            len(entry["name"]), len(extra),
+        ) + entry["name"] + extra
+
+    # Write an entry for the file at path. prepared is the PreparedEntry from
+    # prepare_entry; if it holds no data the file is copied as it is.
+    def write(self, name, path, stat, prepared):
+        encoded_name = name.encode("utf-8")
+        size = prepared.size if prepared.spool else stat.st_size
+        compressed_size = prepared.compressed_size if prepared.spool else stat.st_size
+        # Stored files may still grow while they are copied, leave some room
+        zip64 = max(size, compressed_size) * (1 if prepared.spool else 1.05) >= ZIP64_LIMIT
+        date, dos_time = dos_date_time(stat.st_mtime)
+        entry = {
+            "name": encoded_name,
+            "utf8": not name.isascii(),
+            "method": prepared.method,
+            "version": max(METHOD_VERSIONS[prepared.method], ZIP64_VERSION if zip64 else 0),
+            "zip64": zip64,
+            "date": date,
+            "time": dos_time,
+            "crc": prepared.crc,
+            "compressed_size": compressed_size,
+            "size": size,
+            "mode": stat.st_mode,
+            "offset": self.file.tell(),
+        }
+        self.file.write(self.local_header(entry))
+
+        if prepared.spool:
+            shutil.copyfileobj(prepared.spool, self.file, READ_SIZE)
+            prepared.spool.close()
+        else:
+            crc = 0
+            size = 0
+            with open(path, "rb") as source:
+                while chunk := source.read(READ_SIZE):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    self.file.write(chunk)
+            if size >= ZIP64_LIMIT and not zip64:
+                raise OSError(f"{path} grew beyond the size it was archived with")
+            entry.update(crc=crc, size=size, compressed_size=size)
+            # Rewrite the header now that CRC and size are known
+            end = self.file.tell()
+            self.file.seek(entry["offset"])
+            self.file.write(self.local_header(entry))
+            self.file.seek(end)
+
+        self.entries.append(entry)
+        return entry
+
+    def close(self):
+        central_directory_offset = self.file.tell()
+        for entry in self.entries:
+            values = []
+            compressed_size, size, offset = entry["compressed_size"], entry["size"], entry["offset"]
+            if size >= ZIP64_LIMIT:
+                values.append(size)
+                size = ZIP64_MARKER
+            if compressed_size >= ZIP64_LIMIT:
+                values.append(compressed_size)
+                compressed_size = ZIP64_MARKER
+            if offset >= ZIP64_LIMIT:
+                values.append(offset)
+                offset = ZIP64_MARKER
+            extra = struct.pack(f"<HH{len(values)}Q", 0x0001, 8 * len(values), *values) if values else b""
+            version = max(entry["version"], ZIP64_VERSION if values else 0)
+            flags = (0x0800 if entry["utf8"] else 0) | (0x0002 if entry["method"] == 14 else 0)
+            self.file.write(struct.pack(
+                "<4sBBHHHHHIIIHHHHHII", b"PK\x01\x02", version, 3, version, flags,
+                entry["method"], entry["time"], entry["date"], entry["crc"], compressed_size, size,
+                len(entry["name"]), len(extra), 0, 0, 0, (entry["mode"] & 0xFFFF) << 16, offset,
+            ))
+            self.file.write(entry["name"] + extra)
+
+        central_directory_end = self.file.tell()
+        count = len(self.entries)
+        central_directory_size = central_directory_end - central_directory_offset
+        if count >= 0xFFFF or central_directory_offset >= ZIP64_LIMIT or central_directory_size >= ZIP64_LIMIT:
+            self.file.write(struct.pack(
+                "<4sQHHIIQQQQ", b"PK\x06\x06", 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                count, count, central_directory_size, central_directory_offset,
+            ))
+            self.file.write(struct.pack("<4sIQI", b"PK\x06\x07", 0, central_directory_end, 1))
+            count = min(count, 0xFFFF)
+            central_directory_size = min(central_directory_size, ZIP64_MARKER)
+            central_directory_offset = min(central_directory_offset, ZIP64_MARKER)
+        self.file.write(struct.pack(
+            "<4sHHHHIIH", b"PK\x05\x06", 0, 0, count, count,
+            central_directory_size, central_directory_offset, 0,
+        ))
+        self.file.close()
+
+# Method to get the name of a file inside the archive, relative to base_path.
+# Files outside base_path keep their full path without the drive or root.
+def archive_name(path, base_path):
+    relative_path = os.path.relpath(path, base_path)
+    if relative_path.startswith(os.pardir):
+        relative_path = os.path.splitdrive(os.path.abspath(path))[1].lstrip(os.sep)
+    return relative_path.replace(os.sep, "/")
+
+# Method to compress files into a ZIP archive at output_path. Files are
+# compressed in parallel on worker threads while the archive is written in the
+# order of the input; at most two entries per worker are in flight, and large
+# compressed entries wait in temporary files, so memory use stays bounded.
+# Files that would not shrink are stored. Names in the archive are relative to
+# base_path (the common folder of the files if not given). Yields a dict per
+# written entry; if an error stops the archive, the partial output is removed.
+# With a Metrics, waiting for and writing each entry is timed as the "compress" phase.
+def compress_files(files, output_path, base_path=None, codec="deflate", level=None, workers=None, onerror=None, metrics=None):
+    files = list(files)
+    if not files:
+        return
+    if base_path is None:
+        base_path = os.path.commonpath([os.path.abspath(os.path.dirname(path)) for path in files])
+    method = CODECS[codec]
+    workers = workers or min(32, os.cpu_count() or 1)
+
+    writer = ZipStreamWriter(output_path)
+    completed = False
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for path in files:
+                pending.append((path, executor.submit(prepare_entry, path, method, level)))
+                if len(pending) >= 2 * workers:
+                    yield from write_next_entry(writer, pending, base_path, onerror, metrics)
+            while pending:
+                yield from write_next_entry(writer, pending, base_path, onerror, metrics)
+        writer.close()
+        completed = True
+    finally:
+        if not completed:
+            writer.file.close()
+            os.remove(output_path)
+
+def write_next_entry(writer, pending, base_path, onerror, metrics=None):
+    path, future = pending.popleft()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        prepared = future.result()
+        stat = os.stat(path)
+        entry = writer.write(archive_name(path, base_path), path, stat, prepared)
+    except OSError as e:
+        if not onerror:
+            raise
+        onerror(e)
+        return
+    if metrics:
+        metrics.add("compress", time.perf_counter() - start_wall, time.process_time() - start_cpu, 1, entry["size"])
+    yield {
+        "path": path,
+        "name": entry["name"].decode("utf-8"),
+        "codec": next(codec for codec, method in CODECS.items() if method == entry["method"]),
+        "size": entry["size"],
+        "compressed_size": entry["compressed_size"],
+    }
@@ -0,0 +1,298 @@
+import os
+import time
+from array import array
+from contextlib import nullcontext
+from .filetable import FileTable
+from .hashing import HashEngine, PARTIAL_HASH_SIZE
+from .index import INDEX_COMMIT_INTERVAL
+from .merkle import compute_tree_hashes, find_duplicate_trees
+from .scanner import walk
+
+# Number of files handed to the hash engine at once. Only a batch is kept as a
+# path -> row dict while its hashes come in.
+HASH_BATCH_SIZE = 8192
+
+# Class to find duplicates. Scanned files are kept in a FileTable and grouped by
+# sorting it, see iter_duplicates.
+class DuplicateFinder:
+    def __init__(self, engine=None, index=None, progress=None, metrics=None, onerror=None):
+        # Hash engine to use, picked for the scanned folder's storage if not given
+        self.engine = engine
+        # Persistent FileIndex to reuse hashes of unchanged files from
+        self.index = index
+        # Callback called with (stage, files_done, files_total) while working,
+        # total is None while the tree is still being scanned. It may raise to abort.
+        self.progress = progress
+        # Metrics to record the scan, index and hash phases in
+        self.metrics = metrics
+        # Callback called with the OSError of a file that cannot be hashed, which
+        # is then left out of the hash groups. Defaults to the scan's onerror;
+        # without either, the error is raised.
+        self.onerror = onerror
+        # Files of the last scan, and the rows of it whose full hash is known
+        self.table = None
+        self.hashed_rows = array("I")
+        # Highest roots of identical folders, and (total_size, file_count) per tree hash
+        self.folders_by_tree_hash = {}
+        self.tree_sizes = {}
+        # Files, bytes read and hashes reused from the index by each stage of the hash pipeline
+        self.stage_stats = {stage: {"files": 0, "bytes": 0, "cached": 0} for stage in ("size", "partial", "full")}
+
+    # Scan a folder and return a dict of key -> paths for every group of duplicates.
+    # Extra keyword arguments are passed on to the scanner (include, exclude,
+    # max_depth, follow_symlinks, onerror).
+    def find_duplicates(self, folder, methods=["hash"], **scan_options):
+        self.scan(folder, methods, **scan_options)
+        duplicates = {}
+        for _, file_key, paths in self.iter_duplicates(methods):
+            duplicates[file_key] = paths
+        return duplicates
+
+    # Scan a folder and group its files by the given methods. The "tree" method
+    # finds identical folders by content, see dataoptimizer.merkle.
+    def scan(self, folder, methods=["hash"], **scan_options):
+        needs_hashes = "hash" in methods or "tree" in methods
+        engine = self.engine or HashEngine.for_path(folder)
+        self.onerror = self.onerror or scan_options.get("onerror")
+        index = self.index if needs_hashes else None
+        if index:
+            index.begin_scan(folder, engine.algorithm)
+
+        table = self.table = FileTable(engine.algorithm)
+        self.hashed_rows = array("I")
+        # (dirpath, dirnames, rows) per folder; the rows of a folder are consecutive
+        directories = []
+        last_commit = time.monotonic()
+        for dirpath, dirnames, files in walk(folder, metrics=self.metrics, **scan_options):
+            first_row = len(table)
+            for record in files:
+                if index and index.is_index_file(os.path.abspath(record.path)):
+                    continue
+                row = table.add(dirpath, record.name, record.size, record.mtime_ns)
+                if self.progress:
+                    self.progress("scan", len(table), None)
+                if index:
+                    partial_hash, full_hash = self.record_in_index(index, record)
+                    if partial_hash:
+                        table.set_partial_digest(row, partial_hash)
+                    if full_hash:
+                        table.set_full_digest(row, full_hash)
+            if index and time.monotonic() - last_commit >= INDEX_COMMIT_INTERVAL:
+                # Releases the write lock, e.g. for a watcher on the same index
+                index.commit()
+                last_commit = time.monotonic()
+            if "tree" in methods:
+                directories.append((dirpath, list(dirnames), range(first_row, len(table))))
+
+        if needs_hashes:
+            self.hashed_rows = self.hash_table(table, engine)
+            table.drop_partial_digests()
+        if index:
+            with self.timed("index"):
+                index.finish_scan()
+
+        if "tree" in methods:
+            with self.timed("tree_hash"):
+                tree_directories = [(dirpath, dirnames, ((table.name(row), row, table.sizes[row]) for row in rows)) for dirpath, dirnames, rows in directories]
+                tree_hashes = compute_tree_hashes(tree_directories, table.full_digest)
+                for digest, total_size, tree_file_count, paths in find_duplicate_trees(tree_hashes, folder):
+                    self.folders_by_tree_hash[digest.hex()] = paths
+                    self.tree_sizes[digest.hex()] = (total_size, tree_file_count)
+
+    # Context manager timing a block as a phase of the metrics, if any
+    def timed(self, phase):
+        return self.metrics.phase(phase) if self.metrics else nullcontext()
+
+    # Look up and record a file in the index, timed as the "index" phase
+    def record_in_index(self, index, record):
+        if not self.metrics:
+            return index.record(record)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        hashes = index.record(record)
+        self.metrics.add("index", time.perf_counter() - start_wall, time.process_time() - start_cpu, 1)
+        return hashes
+
+    # Yield (method, key, paths) for every group of duplicates found by the last
+    # scan, one group at a time. Groups are found by sorting the file table, so
+    # only the paths of the current group are built.
+    def iter_duplicates(self, methods=["hash"]):
+        table = self.table
+        for method in ("hash", "size", "name", "date", "tree"):
+            if method not in methods:
+                continue
+            if method == "tree":
+                for file_key, paths in self.folders_by_tree_hash.items():
+                    if len(paths) > 1:
+                        yield method, file_key, paths
+                continue
+            if table is None:
+                continue
+            for rows in self.group_rows(method):
+                yield method, self.group_key(method, rows[0]), [table.path(row) for row in rows]
+
+    # Groups of rows of the file table with the same key for a method
+    def group_rows(self, method):
+        table = self.table
+        if method == "hash":
+            return self.hash_groups()
+        if method == "size":
+            return table.group_rows(table.sizes.__getitem__)
+        if method == "name":
+            return table.group_rows(table.name_bytes)
+        return table.group_rows(table.mtimes.__getitem__)
+
+    # Groups of rows with the same full hash. Rows are sorted by size first and
+    # then by digest within each size, so digests are only held for one size at a time.
+    def hash_groups(self):
+        table = self.table
+        for size_rows in table.group_rows(table.sizes.__getitem__, self.hashed_rows):
+            yield from table.group_rows(table.full_digest, size_rows)
+
+    # Key a group is reported under: the hash as hex, the size, the name or the
+    # modification time in seconds
+    def group_key(self, method, row):
+        table = self.table
+        if method == "hash":
+            return table.full_digest(row).hex()
+        if method == "size":
+            return table.sizes[row]
+        if method == "name":
+            return table.name(row)
+        return table.mtimes[row] / 1e9
+
+    # Dict of key -> paths for every group of duplicates of a method, built on demand
+    def groups(self, method):
+        return {file_key: paths for _, file_key, paths in self.iter_duplicates([method])}
+
+    @property
+    def files_by_hash(self):
+        return self.groups("hash")
+
+    @property
+    def files_by_size(self):
+        return self.groups("size")
+
+    @property
+    def files_by_name(self):
+        return self.groups("name")
+
+    @property
+    def files_by_date(self):
+        return self.groups("date")
+
+    # Hash files in three stages: group by size, then hash the head and tail of
+    # files sharing a size, then fully hash only the files that still collide.
+    # Files that cannot have a duplicate are never read and are left out of the
+    # result. Paths keep the order of the input list. Hashes found in
+    # cached_hashes (path -> (partial_hash, full_hash)) are not computed again.
+    # Returns a dict of full hash -> paths.
+    def hash_files_staged(self, files, engine, cached_hashes={}):
+        table = FileTable(engine.algorithm)
+        for path, size in files:
+            row = table.add(os.path.dirname(path), os.path.basename(path), size, 0)
+            partial_hash, full_hash = cached_hashes.get(path, (None, None))
+            if partial_hash:
+                table.set_partial_digest(row, partial_hash)
+            if full_hash:
+                table.set_full_digest(row, full_hash)
+        files_by_hash = {}
+        for row in self.hash_table(table, engine):
+            files_by_hash.setdefault(table.full_digest(row).hex(), []).append(table.path(row))
+        return files_by_hash
+
+    # Run the hash stages over a file table, storing the digests in it, and
+    # return the rows whose full hash is known, in row order. Digests already in
+    # the table (e.g. from the index) are not computed again.
+    def hash_table(self, table, engine):
+        self.stage_stats["size"]["files"] += len(table)
+        size_groups = list(table.group_rows(table.sizes.__getitem__))
+        to_hash = []
+        for rows in size_groups:
+            for row in rows:
+                self.stage_stats["partial"]["files"] += 1
+                if table.partial_digest(row) is not None:
+                    self.stage_stats["partial"]["cached"] += 1
+                else:
+                    to_hash.append(row)
+                    self.stage_stats["partial"]["bytes"] += min(table.sizes[row], 2 * PARTIAL_HASH_SIZE)
+        self.hash_with_progress(engine, table, to_hash, "partial", partial=True)
+
+        # Partial hashes are only comparable between files of the same size, so
+        # each size group is sorted on its own
+        hashed_rows = array("I")
+        # Full hashes of small files, taken from their partial hash, to store in the index
+        covered_hashes = {}
+        to_hash = []
+        for size_rows in size_groups:
+            size = table.sizes[size_rows[0]]
+            # Files that could not be hashed have no digest and drop out here
+            hashable_rows = [row for row in size_rows if table.partial_digest(row) is not None]
+            for rows in table.group_rows(table.partial_digest, hashable_rows):
+                hashed_rows.extend(rows)
+                if size <= 2 * PARTIAL_HASH_SIZE:
+                    # The partial hash already covered the whole file
+                    partial_hash = table.partial_digest(rows[0])
+                    for row in rows:
+                        if table.full_digest(row) is None:
+                            table.set_full_digest(row, partial_hash)
+                            if self.index:
+                                covered_hashes[table.path(row)] = partial_hash.hex()
+                    if len(covered_hashes) >= HASH_BATCH_SIZE:
+                        self.store_covered_hashes(covered_hashes)
+                    continue
+                for row in rows:
+                    self.stage_stats["full"]["files"] += 1
+                    if table.full_digest(row) is not None:
+                        self.stage_stats["full"]["cached"] += 1
+                    else:
+                        to_hash.append(row)
+                        self.stage_stats["full"]["bytes"] += size
+        self.store_covered_hashes(covered_hashes)
+        self.hash_with_progress(engine, table, to_hash, "full")
+        return array("I", sorted(row for row in hashed_rows if table.full_digest(row) is not None))
+
+    # Store full hashes taken from partial hashes in the index and clear them.
+    # Stored as full hashes too, so the index can be queried for duplicates.
+    def store_covered_hashes(self, covered_hashes):
+        if self.index and covered_hashes:
+            with self.timed("index"):
+                self.index.store_hashes(full_hashes=covered_hashes)
+        covered_hashes.clear()
+
+    # Hash rows of a file table with the engine and store the digests in the
+    # table and the index, reporting progress per file. The time up to each hash
+    # is added to the "hash_<stage>" phase.
+    def hash_with_progress(self, engine, table, rows, stage, partial=False):
+        done = 0
+        last_wall = time.perf_counter()
+        last_cpu = time.process_time()
+        for start in range(0, len(rows), HASH_BATCH_SIZE):
+            batch = {table.path(row): row for row in rows[start:start + HASH_BATCH_SIZE]}
+            # Hashes to store in the index, if any
+            hashes = {} if self.index else None
+            for path, file_hash in engine.hash_files(((path, table.sizes[row]) for path, row in batch.items()), partial, self.onerror):
+                row = batch[path]
+                if hashes is not None:
+                    hashes[path] = file_hash
+                if partial:
+                    table.set_partial_digest(row, file_hash)
+                else:
+                    table.set_full_digest(row, file_hash)
+                done += 1
+                if self.metrics:
+                    now_wall = time.perf_counter()
+                    now_cpu = time.process_time()
+                    size = min(table.sizes[row], 2 * PARTIAL_HASH_SIZE) if partial else table.sizes[row]
+                    self.metrics.add(f"hash_{stage}", now_wall - last_wall, now_cpu - last_cpu, 1, size)
+                    last_wall, last_cpu = now_wall, now_cpu
+                if self.progress:
+                    self.progress(stage, done, len(rows))
+            if self.index:
+                with self.timed("index"):
+                    if partial:
+                        self.index.store_hashes(partial_hashes=hashes)
+                    else:
+                        self.index.store_hashes(full_hashes=hashes)
+                    # Other scans sharing the index can write while the next batch is hashed
+                    self.index.commit()
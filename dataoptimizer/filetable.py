@@ -0,0 +1,113 @@
+import os
+from array import array
+from .hashing import HASH_ALGORITHMS
+
+# Class for a compact, column-oriented table of scanned files. Each folder path
+# is stored once and referenced by id, names are packed into one byte buffer and
+# sizes and modification times live in typed arrays, so a row costs a few dozen
+# bytes instead of a path string, a tuple and a dict entry per grouping. Hash
+# digests are kept as raw bytes, and only for rows that get a hash. Rows are
+# numbered in the order they were added; grouping sorts row numbers by a column
+# instead of building a dict of lists per key.
+class FileTable:
+    def __init__(self, algorithm):
+        self.digest_size = HASH_ALGORITHMS[algorithm]().digest_size
+        self.directories = []
+        self.directory_ids = {}
+        self.directory_column = array("I")
+        self.name_data = bytearray()
+        self.name_offsets = array("Q", [0])
+        self.sizes = array("Q")
+        self.mtimes = array("q")
+        # Digest slot of each row, or -1 if it has none. Slots index into the
+        # digest buffers, which only grow for rows that get a digest.
+        self.partial_slots = array("i")
+        self.full_slots = array("i")
+        self.partial_digests = bytearray()
+        self.full_digests = bytearray()
+
+    def __len__(self):
+        return len(self.sizes)
+
+    # Add a file and return its row
+    def add(self, dirpath, name, size, mtime_ns):
+        directory_id = self.directory_ids.get(dirpath)
+        if directory_id is None:
+            directory_id = self.directory_ids[dirpath] = len(self.directories)
+            self.directories.append(dirpath)
+        self.directory_column.append(directory_id)
+        self.name_data += os.fsencode(name)
+        self.name_offsets.append(len(self.name_data))
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+        self.partial_slots.append(-1)
+        self.full_slots.append(-1)
+        return len(self.sizes) - 1
+
+    # Add a FileRecord and return its row
+    def add_record(self, record):
+        return self.add(os.path.dirname(record.path), record.name, record.size, record.mtime_ns)
+
+    # Name of a row as raw bytes, the sort key for grouping by name
+    def name_bytes(self, row):
+        return bytes(self.name_data[self.name_offsets[row]:self.name_offsets[row + 1]])
+
+    def name(self, row):
+        return os.fsdecode(self.name_bytes(row))
+
+    def path(self, row):
+        return os.path.join(self.directories[self.directory_column[row]], self.name(row))
+
+    # Store a digest of a row, given as bytes or as a hex string
+    def set_partial_digest(self, row, digest):
+        self.set_digest(row, digest, self.partial_slots, self.partial_digests)
+
+    def set_full_digest(self, row, digest):
+        self.set_digest(row, digest, self.full_slots, self.full_digests)
+
+    def set_digest(self, row, digest, slots, digests):
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest)
+        slot = slots[row]
+        if slot < 0:
+            slots[row] = len(digests) // self.digest_size
+            digests += digest
+        else:
+            digests[slot * self.digest_size:(slot + 1) * self.digest_size] = digest
+
+    # Digest of a row as bytes, or None if it has none
+    def partial_digest(self, row):
+        return self.get_digest(row, self.partial_slots, self.partial_digests)
+
+    def full_digest(self, row):
+        return self.get_digest(row, self.full_slots, self.full_digests)
+
+    def get_digest(self, row, slots, digests):
+        slot = slots[row]
+        if slot < 0:
+            return None
+        return bytes(digests[slot * self.digest_size:(slot + 1) * self.digest_size])
+
+    # Free the partial digests once only the full ones are needed
+    def drop_partial_digests(self):
+        self.partial_slots = array("i", [-1]) * len(self)
+        self.partial_digests = bytearray()
+
+    # Yield every group of at least two rows with the same key, as lists of rows
+    # in row order. rows defaults to all rows and must all have a key.
+    def group_rows(self, key, rows=None):
+        if rows is None:
+            rows = range(len(self))
+        group = []
+        group_key = None
+        for row in sorted(rows, key=key):
+            row_key = key(row)
+            if group and row_key == group_key:
+                group.append(row)
+                continue
+            if len(group) > 1:
+                yield group
+            group = [row]
+            group_key = row_key
+        if len(group) > 1:
+            yield group
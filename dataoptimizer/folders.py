@@ -0,0 +1,63 @@
+import os
+from collections import defaultdict
+from .scanner import walk
+
+# Method to create a tree structure of folders
+def map_folder_structure(path, **scan_options):
+    folder_tree = defaultdict(dict)
+    for root, dirs, files in walk(path, **scan_options):
+        # Remove the base directory from the path
+        relative_root = os.path.relpath(root, path)
+        folder_tree[relative_root] = {
+            "dirs": sorted(dirs),
+            "files": sorted(file.name for file in files)
+        }
+    return folder_tree
+
+# Method to create the tree structures of all subfolders of a path in a single walk
+def map_folder_structures(path, **scan_options):
+    folder_trees = {}
+    for root, dirs, files in walk(path, **scan_options):
+        relative_root = os.path.relpath(root, path)
+        if relative_root == ".":
+            for folder in dirs:
+                folder_trees[os.path.join(path, folder)] = defaultdict(dict)
+            continue
+        top_folder = os.path.join(path, relative_root.split(os.sep)[0])
+        folder_trees[top_folder][os.path.relpath(root, top_folder)] = {
+            "dirs": sorted(dirs),
+            "files": sorted(file.name for file in files)
+        }
+    return folder_trees
+
+# Method to calculate the percentage of matching subfolders
+def calculate_similarity_percentage(folder1, folder2):
+    set1 = set(folder1.keys())
+    set2 = set(folder2.keys())
+    common_folders = set1 & set2
+    if not set1 and not set2:
+        return 100
+    return len(common_folders) / min(len(set1), len(set2)) * 100
+
+# Method to check if the number of subfolders is within ±25%
+def is_folder_count_similar(folder1, folder2):
+    count1 = len(folder1)
+    count2 = len(folder2)
+    lower_bound = 0.75 * count1
+    upper_bound = 1.25 * count1
+    return lower_bound <= count2 <= upper_bound
+
+# Method to compare the tree structure of two folders
+def compare_folder_structures(tree1, tree2):
+    similar_folders = []
+    for folder in tree1:
+        if folder in tree2 and tree1[folder] == tree2[folder]:
+            similar_folders.append(folder)
+    return similar_folders
+
+# Method to create a list of folders below a base path, yielding each created path
+def create_folders(base_path, folder_list):
+    for folder in folder_list:
+        folder_path = os.path.join(base_path, folder.strip())
+        os.makedirs(folder_path, exist_ok=True)
+        yield folder_path
@@ -0,0 +1,159 @@
+import os
+import hashlib
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+
+# Default size of a single read while hashing
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Files at least this large are hashed through mmap instead of reads
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Supported hash algorithms. md5 is kept for compatibility with older results.
+HASH_ALGORITHMS = {
+    "blake2b": hashlib.blake2b,
+    "sha256": hashlib.sha256,
+    "md5": hashlib.md5,
+}
+DEFAULT_ALGORITHM = "blake2b"
+
+# Read buffers, reused by all files hashed on the same thread
+_buffers = threading.local()
+
+# Number of bytes read from the head and the tail of a file for the partial hash
+PARTIAL_HASH_SIZE = 4096
+
+# Engine settings per storage type. Spinning disks get few workers and large
+# reads, since parallel reads on them mostly add seeks.
+STORAGE_PROFILES = {
+    "ssd": {
+        "workers": min(32, (os.cpu_count() or 1) * 2),
+        "buffer_size": 1024 * 1024,
+        "max_inflight_bytes": 512 * 1024 * 1024,
+    },
+    "hdd": {
+        "workers": 2,
+        "buffer_size": 4 * 1024 * 1024,
+        "max_inflight_bytes": 128 * 1024 * 1024,
+    },
+}
+
+# Method to get this thread's read buffer of the given size
+def get_buffer(buffer_size):
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = _buffers.buffer = bytearray(buffer_size)
+    return buffer
+
+# Hashing function. Large files are mapped into memory and hashed in one call,
+# others are read with readinto into a reused buffer, so no chunk allocates.
+def hash_file(filepath, buffer_size=DEFAULT_BUFFER_SIZE, algorithm=DEFAULT_ALGORITHM):
+    hash_obj = HASH_ALGORITHMS[algorithm]()
+    with open(filepath, 'rb') as file:
+        if os.fstat(file.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hash_obj.update(mapped)
+        else:
+            buffer = get_buffer(buffer_size)
+            view = memoryview(buffer)
+            while size := file.readinto(buffer):
+                hash_obj.update(view[:size])
+    return hash_obj.hexdigest()
+
+# Hashing function for the first and last PARTIAL_HASH_SIZE bytes of a file.
+# Files no larger than both chunks together are read completely, so their
+# partial hash is identical to the full hash.
+def hash_file_partial(filepath, size, algorithm=DEFAULT_ALGORITHM):
+    hash_obj = HASH_ALGORITHMS[algorithm]()
+    with open(filepath, 'rb') as file:
+        if size <= 2 * PARTIAL_HASH_SIZE:
+            hash_obj.update(file.read())
+        else:
+            hash_obj.update(file.read(PARTIAL_HASH_SIZE))
+            file.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+            hash_obj.update(file.read(PARTIAL_HASH_SIZE))
+    return hash_obj.hexdigest()
+
+# Method to detect whether a path lives on a spinning disk ("hdd") or not ("ssd").
+# Uses the rotational flag of the Linux block device and falls back to "ssd"
+# when it cannot be determined (other platforms, network or virtual filesystems).
+def detect_storage_type(path):
+    try:
+        device = os.stat(path).st_dev
+        device_path = os.path.realpath(f"/sys/dev/block/{os.major(device)}:{os.minor(device)}")
+    except (OSError, AttributeError):
+        return "ssd"
+    # Partitions have no queue directory of their own, their parent disk does
+    for candidate in (device_path, os.path.dirname(device_path)):
+        try:
+            with open(os.path.join(candidate, "queue", "rotational")) as f:
+                return "hdd" if f.read().strip() == "1" else "ssd"
+        except OSError:
+            continue
+    return "ssd"
+
+# Class to hash many files concurrently on a thread or process pool
+class HashEngine:
+    def __init__(self, workers=None, buffer_size=None, max_inflight_bytes=None, storage="ssd", use_processes=False, algorithm=DEFAULT_ALGORITHM):
+        if algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"Unknown hash algorithm {algorithm!r}, choose one of {', '.join(HASH_ALGORITHMS)}")
+        profile = STORAGE_PROFILES[storage]
+        self.storage = storage
+        self.workers = workers or profile["workers"]
+        self.buffer_size = buffer_size or profile["buffer_size"]
+        self.max_inflight_bytes = max_inflight_bytes or profile["max_inflight_bytes"]
+        self.use_processes = use_processes
+        self.algorithm = algorithm
+
+    # Create an engine with the defaults for the storage the path lives on
+    @classmethod
+    def for_path(cls, path, **kwargs):
+        kwargs.setdefault("storage", detect_storage_type(path))
+        return cls(**kwargs)
+
+    # Hash (path, size) pairs and yield (path, digest) pairs as they complete.
+    # At most max_inflight_bytes worth of files are queued or being hashed at
+    # once; a single file larger than the limit is still hashed on its own. A
+    # file that cannot be read (e.g. it was deleted meanwhile) is passed to
+    # onerror as an OSError and left out; without onerror the error is raised.
+    def hash_files(self, files, partial=False, onerror=None):
+        executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=self.workers) as executor:
+            pending = {}
+            inflight_bytes = 0
+            for path, size in files:
+                cost = min(size, 2 * PARTIAL_HASH_SIZE) if partial else size
+                while pending and (inflight_bytes + cost > self.max_inflight_bytes or len(pending) >= 4 * self.workers):
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        done_path, done_cost = pending.pop(future)
+                        inflight_bytes -= done_cost
+                        digest = digest_of(future, onerror)
+                        if digest is not None:
+                            yield done_path, digest
+
+                if partial:
+                    future = executor.submit(hash_file_partial, path, size, self.algorithm)
+                else:
+                    future = executor.submit(hash_file, path, self.buffer_size, self.algorithm)
+                pending[future] = (path, cost)
+                inflight_bytes += cost
+
+            for future in as_completed(pending):
+                digest = digest_of(future, onerror)
+                if digest is not None:
+                    yield pending[future][0], digest
+
+# Method to get the digest of a finished hash, or None if its file could not be
+# read and the OSError was passed to onerror
+def digest_of(future, onerror):
+    try:
+        return future.result()
+    except OSError as e:
+        if not onerror:
+            raise
+        onerror(e)
+        return None
@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import time
+from .hashing import DEFAULT_ALGORITHM
+
+# Seconds a connection waits for another one to release the write lock, e.g.
+# while parallel scans of several roots sharing the index take turns
+BUSY_TIMEOUT = 300
+
+# Seconds between commits of the files recorded in the index during a walk.
+# Each commit releases the write lock, so scans and watchers sharing one index
+# take turns writing to it however slowly their folders are listed.
+INDEX_COMMIT_INTERVAL = 0.5
+
+# Method to get the default location of the file index, outside any scanned folder
+def default_index_path():
+    if os.name == "nt":
+        cache_dir = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_dir, "dataoptimizer", "index.sqlite3")
+
+# Method to get the [low, high) string range covering every path below a folder
+def path_range(folder):
+    prefix = os.path.join(os.path.abspath(folder), "")
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Class for the persistent file index. Hashes are reused as long as a file's
+# (device, inode, size, mtime_ns) is unchanged, even if it was moved or renamed
+# within the index, and only by scans that use the same hash algorithm. Rows of
+# files not seen again by a scan are dropped when the scan finishes.
+class FileIndex:
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path or default_index_path())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS scans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                root TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                partial_hash TEXT,
+                full_hash TEXT,
+                scan_id INTEGER NOT NULL,
+                hash_algorithm TEXT NOT NULL DEFAULT 'md5'
+            );
+            CREATE INDEX IF NOT EXISTS files_identity ON files (device, inode, size, mtime_ns);
+            CREATE INDEX IF NOT EXISTS files_size ON files (size);
+        """)
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+        if "hash_algorithm" not in columns:
+            # Indexes written before the algorithm was recorded only hold MD5 hashes
+            self.connection.execute("ALTER TABLE files ADD COLUMN hash_algorithm TEXT NOT NULL DEFAULT 'md5'")
+            self.connection.commit()
+        self.scan_id = None
+        self.scan_root = None
+        self.hash_algorithm = None
+
+    def close(self):
+        self.connection.close()
+
+    # Check whether a path belongs to the index database itself
+    def is_index_file(self, path):
+        return path.startswith(self.path)
+
+    def begin_scan(self, folder, hash_algorithm=DEFAULT_ALGORITHM):
+        self.scan_root = os.path.abspath(folder)
+        self.hash_algorithm = hash_algorithm
+        cursor = self.connection.execute("INSERT INTO scans (root, started_at) VALUES (?, ?)", (self.scan_root, time.time()))
+        self.scan_id = cursor.lastrowid
+        # Committed right away, or the write lock would be held for the whole walk
+        self.connection.commit()
+
+    # Record a FileRecord seen by the current scan and return its cached
+    # (partial_hash, full_hash), or (None, None) if it is new or has changed
+    def record(self, record):
+        identity = (record.device, record.inode, record.size, record.mtime_ns)
+        row = self.connection.execute(
+            "SELECT partial_hash, full_hash FROM files WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? AND hash_algorithm = ? "
+            "ORDER BY full_hash IS NULL, partial_hash IS NULL LIMIT 1",
+            (*identity, self.hash_algorithm),
+        ).fetchone()
+        hashes = row or (None, None)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, device, inode, size, mtime_ns, partial_hash, full_hash, scan_id, hash_algorithm) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (os.path.abspath(record.path), *identity, *hashes, self.scan_id, self.hash_algorithm),
+        )
+        return hashes
+
+    # Store hashes computed during the current scan, as a dict of path -> hash
+    def store_hashes(self, partial_hashes=None, full_hashes=None):
+        if partial_hashes:
+            self.connection.executemany(
+                "UPDATE files SET partial_hash = ? WHERE path = ?",
+                ((digest, os.path.abspath(path)) for path, digest in partial_hashes.items()),
+            )
+        if full_hashes:
+            self.connection.executemany(
+                "UPDATE files SET full_hash = ? WHERE path = ?",
+                ((digest, os.path.abspath(path)) for path, digest in full_hashes.items()),
+            )
+
+    # Drop the rows of files that no longer exist, as a list of paths
+    def forget(self, paths):
+        self.connection.executemany("DELETE FROM files WHERE path = ?", ((os.path.abspath(path),) for path in paths))
+
+    def commit(self):
+        self.connection.commit()
+
+    # Undo everything recorded since the last commit
+    def rollback(self):
+        self.connection.rollback()
+
+    # Groups of paths below a folder with the same full hash, as last recorded
+    def duplicate_groups(self, folder, hash_algorithm=DEFAULT_ALGORITHM):
+        low, high = path_range(folder)
+        rows = self.connection.execute(
+            "SELECT full_hash, path FROM files WHERE path >= ? AND path < ? AND hash_algorithm = ? AND full_hash IN ("
+            "SELECT full_hash FROM files WHERE path >= ? AND path < ? AND hash_algorithm = ? AND full_hash IS NOT NULL "
+            "GROUP BY full_hash HAVING COUNT(*) > 1) ORDER BY full_hash, path",
+            (low, high, hash_algorithm, low, high, hash_algorithm),
+        )
+        groups = {}
+        for full_hash, path in rows:
+            groups.setdefault(full_hash, []).append(path)
+        return groups
+
+    # The largest files below a folder, as a list of (path, size), as last recorded
+    def largest_files(self, folder, limit):
+        low, high = path_range(folder)
+        return self.connection.execute(
+            "SELECT path, size FROM files WHERE path >= ? AND path < ? ORDER BY size DESC LIMIT ?",
+            (low, high, limit),
+        ).fetchall()
+
+    # Drop the files below the scanned folder that this scan did not see
+    def finish_scan(self):
+        low, high = path_range(self.scan_root)
+        self.connection.execute(
+            "DELETE FROM files WHERE path >= ? AND path < ? AND scan_id != ?",
+            (low, high, self.scan_id),
+        )
+        self.connection.execute("UPDATE scans SET finished_at = ? WHERE id = ?", (time.time(), self.scan_id))
+        self.connection.commit()
+        self.scan_id = None
+        self.scan_root = None
+        self.hash_algorithm = None
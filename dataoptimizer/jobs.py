@@ -0,0 +1,82 @@
+import queue
+import threading
+from .metrics import Metrics, profiled
+
+# Interval in milliseconds at which the GUI applies queued job output and progress
+UPDATE_INTERVAL_MS = 100
+
+# Maximum number of output messages applied to the GUI per update
+MAX_OUTPUT_PER_UPDATE = 2000
+
+class JobCancelled(Exception):
+    pass
+
+# Class to run a function on a background thread. The function gets the job as
+# its first argument and reports through output() and set_progress(), which are
+# safe to call from the worker thread. The GUI picks up both at a fixed rate with
+# drain_output() and the progress attribute instead of redrawing per file.
+# The function can record its phases in the job's metrics. If profile_path is
+# set, the run is profiled, see dataoptimizer.metrics.profiled.
+class Job:
+    def __init__(self, target, *args, profile_path=None, trace_memory=False, **kwargs):
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.metrics = Metrics()
+        self.profile_path = profile_path
+        self.trace_memory = trace_memory
+        self.output_queue = queue.SimpleQueue()
+        self.cancel_event = threading.Event()
+        # Latest (fraction, text) progress; replaced as a whole so readers never see a torn value
+        self.progress = (0, "")
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            if self.profile_path:
+                with profiled(self.profile_path, self.trace_memory):
+                    self.result = self.target(self, *self.args, **self.kwargs)
+            else:
+                self.result = self.target(self, *self.args, **self.kwargs)
+        except JobCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+
+    @property
+    def finished(self):
+        return not self.thread.is_alive()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    # Raise JobCancelled in the worker thread once the job has been cancelled
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled()
+
+    def output(self, text):
+        self.output_queue.put(text)
+
+    def set_progress(self, fraction, text):
+        self.progress = (fraction, text)
+
+    # Take up to limit queued output messages, or all of them if limit is None
+    def drain_output(self, limit=None):
+        messages = []
+        while limit is None or len(messages) < limit:
+            try:
+                messages.append(self.output_queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
@@ -0,0 +1,159 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Policies for picking the copy of a duplicate group that is kept
+KEEP_POLICIES = ("oldest", "shortest")
+
+# Ways to replace the other copies: a reflink shares the data but stays a separate
+# file, a hardlink makes the copies one file. "auto" tries a reflink first.
+LINK_MODES = ("auto", "reflink", "hardlink")
+
+DEFAULT_LINK_WORKERS = 8
+
+# ioctl request to clone a whole file on Linux (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+# Size of a single read while comparing files
+COMPARE_SIZE = 1024 * 1024
+
+# Suffix of the hidden file a link is created under before it replaces a duplicate
+TEMP_SUFFIX = ".dedup-link"
+
+# Method to pick the path to keep from a group of duplicates. Paths below the
+# preferred root win, the policy decides between the rest.
+def choose_keeper(paths, policy="oldest", preferred_root=None):
+    candidates = paths
+    if preferred_root:
+        prefix = os.path.join(os.path.abspath(preferred_root), "")
+        candidates = [path for path in paths if os.path.abspath(path).startswith(prefix)] or paths
+    if policy == "shortest":
+        return min(candidates, key=lambda path: (len(path), path))
+    return min(candidates, key=lambda path: (os.stat(path).st_mtime_ns, path))
+
+# Method to compare two files byte by byte
+def files_equal(path1, path2):
+    with open(path1, "rb") as file1, open(path2, "rb") as file2:
+        while True:
+            chunk1 = file1.read(COMPARE_SIZE)
+            if chunk1 != file2.read(COMPARE_SIZE):
+                return False
+            if not chunk1:
+                return True
+
+# Method to create a reflink of source at destination. Raises OSError where the
+# filesystem or platform cannot share data between files.
+def reflink(source, destination):
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+# Method to create a link to keeper at a temporary path and return the mode used
+def create_link(keeper, duplicate, temp_path, mode):
+    if mode in ("auto", "reflink"):
+        try:
+            reflink(keeper, temp_path)
+            # A reflink is a file of its own and keeps the duplicate's permissions and times
+            shutil.copystat(duplicate, temp_path)
+            return "reflink"
+        except OSError:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            if mode == "reflink":
+                raise
+    os.link(keeper, temp_path)
+    return "hardlink"
+
+# Method to replace one duplicate by a link to the kept file. The link is made
+# under a temporary name and renamed over the duplicate, so the duplicate's path
+# always holds either the old or the new file. Returns an event dict.
+def replace_with_link(keeper, duplicate, mode="auto"):
+    keeper_stat = os.stat(keeper)
+    duplicate_stat = os.stat(duplicate)
+    if (keeper_stat.st_dev, keeper_stat.st_ino) == (duplicate_stat.st_dev, duplicate_stat.st_ino):
+        return {"action": "skipped", "path": duplicate, "reason": "already linked"}
+    if keeper_stat.st_dev != duplicate_stat.st_dev:
+        return {"action": "skipped", "path": duplicate, "reason": "on another filesystem"}
+    if keeper_stat.st_size != duplicate_stat.st_size or not files_equal(keeper, duplicate):
+        return {"action": "skipped", "path": duplicate, "reason": "content differs"}
+
+    temp_path = os.path.join(os.path.dirname(duplicate), "." + os.path.basename(duplicate) + TEMP_SUFFIX)
+    try:
+        os.unlink(temp_path)
+    except FileNotFoundError:
+        pass
+    used_mode = create_link(keeper, duplicate, temp_path, mode)
+    try:
+        # Both files are checked again after the link is made, so a change to
+        # either one since the byte comparison never replaces the duplicate
+        for path, verified_stat in ((duplicate, duplicate_stat), (keeper, keeper_stat)):
+            current_stat = os.stat(path)
+            if (current_stat.st_ino, current_stat.st_size, current_stat.st_mtime_ns) != (verified_stat.st_ino, verified_stat.st_size, verified_stat.st_mtime_ns):
+                os.unlink(temp_path)
+                return {"action": "skipped", "path": duplicate, "reason": "changed while verifying"}
+        os.rename(temp_path, duplicate)
+    except OSError:
+        os.unlink(temp_path)
+        raise
+    # The data only becomes free once no other hardlink to the duplicate is left
+    reclaimed = duplicate_stat.st_size if duplicate_stat.st_nlink == 1 else 0
+    return {"action": "linked", "path": duplicate, "keeper": keeper, "mode": used_mode, "reclaimed": reclaimed}
+
+# Method to replace all but one file of a group of duplicates and return the events
+def link_group(paths, policy, preferred_root, mode):
+    try:
+        keeper = choose_keeper(paths, policy, preferred_root)
+    except OSError as e:
+        return [{"action": "error", "path": e.filename or paths[0], "error": str(e)}]
+    events = []
+    for path in paths:
+        if path == keeper:
+            continue
+        try:
+            events.append(replace_with_link(keeper, path, mode))
+        except OSError as e:
+            events.append({"action": "error", "path": path, "error": str(e)})
+    return events
+
+# Method to replace duplicates with links to one kept copy per group, one group
+# per worker. groups are lists of paths with the same content, e.g. the hash
+# groups of DuplicateFinder; every file is still compared byte by byte before
+# it is replaced. Yields an event dict per duplicate, see describe_link_event.
+def link_duplicates(groups, policy="oldest", preferred_root=None, mode="auto", workers=None):
+    if policy not in KEEP_POLICIES:
+        raise ValueError(f"Unknown keep policy {policy!r}, choose one of {', '.join(KEEP_POLICIES)}")
+    if mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode {mode!r}, choose one of {', '.join(LINK_MODES)}")
+    workers = workers or DEFAULT_LINK_WORKERS
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        try:
+            for paths in groups:
+                while len(pending) >= 4 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+                pending.add(executor.submit(link_group, paths, policy, preferred_root, mode))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+# Method to turn a link event into a line of text
+def describe_link_event(event):
+    if event["action"] == "linked":
+        return f"Replaced by {event['mode']}: {event['path']} -> {event['keeper']}\n"
+    if event["action"] == "skipped":
+        return f"Skipped ({event['reason']}): {event['path']}\n"
+    return f"Error at {event['path']}: {event['error']}\n"
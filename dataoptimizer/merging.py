@@ -0,0 +1,422 @@
+import errno
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import stat
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .index import default_index_path
+
+# Actions of a merge plan: move a file by renaming it, copy it to another
+# filesystem, skip a source whose destination is already identical (or remove
+# it, if asked to), or leave a source alone because a different file exists at
+# its destination
+MERGE_ACTIONS = ("move", "copy", "identical", "conflict")
+
+DEFAULT_MERGE_WORKERS = 8
+
+# Largest number of bytes handed to a single kernel copy call
+KERNEL_COPY_CHUNK = 64 * 1024 * 1024
+
+# Size of a single read when a copy falls back to user space
+READ_SIZE = 1024 * 1024
+
+# Errors of copy_file_range and sendfile after which the next copy method is tried
+KERNEL_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+# Suffix of the hidden file a cross-device copy is written to before it is renamed into place
+PARTIAL_SUFFIX = ".merge-partial"
+
+JOURNAL_VERSION = 1
+
+# Planned action for one file, relative to both the merged and the primary folder
+MergeEntry = namedtuple("MergeEntry", ["action", "relative_path", "size"])
+
+# Class for the plan of merging a folder into a primary folder
+class MergePlan:
+    def __init__(self, primary, folder, entries=None, directories=None, remove_identical=False):
+        self.primary = primary
+        self.folder = folder
+        self.entries = entries or []
+        # Relative folders to create below the primary folder, parents first
+        self.directories = directories or []
+        # Whether sources whose destination is already identical are removed
+        self.remove_identical = remove_identical
+
+    def source(self, entry):
+        return os.path.join(self.folder, entry.relative_path)
+
+    def destination(self, entry):
+        return os.path.join(self.primary, entry.relative_path)
+
+    # Number of files and bytes per action
+    def summary(self):
+        summary = {action: {"files": 0, "bytes": 0} for action in MERGE_ACTIONS}
+        for entry in self.entries:
+            summary[entry.action]["files"] += 1
+            summary[entry.action]["bytes"] += entry.size
+        return summary
+
+# Method to get the device of a path, or of its closest existing parent
+def device_of(path):
+    path = os.path.abspath(path)
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+# Method to check whether the file at destination has the same content as source
+def is_identical(source, source_stat, destination, destination_stat):
+    if stat.S_ISLNK(source_stat.st_mode) or stat.S_ISLNK(destination_stat.st_mode):
+        return stat.S_ISLNK(source_stat.st_mode) and stat.S_ISLNK(destination_stat.st_mode) and os.readlink(source) == os.readlink(destination)
+    if not (stat.S_ISREG(source_stat.st_mode) and stat.S_ISREG(destination_stat.st_mode)):
+        return False
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+    return filecmp.cmp(source, destination, shallow=False)
+
+# Method to check whether source and destination are the same directory entry,
+# e.g. because one of their folders is a symlink to the other, or the same file
+def is_same_entry(source, destination):
+    if os.path.basename(source) == os.path.basename(destination) and os.path.realpath(os.path.dirname(source)) == os.path.realpath(os.path.dirname(destination)):
+        return True
+    try:
+        return os.path.samestat(os.lstat(source), os.lstat(destination))
+    except OSError:
+        return False
+
+# Method to raise ValueError if folder cannot be merged into primary because it
+# is the same folder, e.g. through a symlink, or one of them contains the other
+def check_merge_folders(primary, folder):
+    real_primary = os.path.realpath(primary)
+    real_folder = os.path.realpath(folder)
+    if real_primary == real_folder:
+        raise ValueError(f"Cannot merge {folder} into {primary}: they are the same folder")
+    if os.path.commonpath([real_primary, real_folder]) in (real_primary, real_folder):
+        raise ValueError(f"Cannot merge {folder} into {primary}: one folder contains the other")
+
+# Method to get the relative paths an interrupted merge of folder into primary
+# planned to move or copy but did not journal as done. A file among them whose
+# destination is identical was copied by that merge, which did not get to
+# remove the source.
+def unfinished_moves(journal_path, primary, folder):
+    resumed = load_journal(journal_path, primary, folder)
+    if not resumed:
+        return set()
+    plan, done = resumed
+    return {entry.relative_path for index, entry in enumerate(plan.entries) if entry.action in ("move", "copy") and index not in done}
+
+# Method to plan merging folder into primary in a single pass over folder,
+# without changing anything. Symlinks are planned like files and never followed.
+# Raises ValueError if the folders overlap, see check_merge_folders. The plan
+# always reflects the current tree; the journal of an interrupted merge (at the
+# default location unless journal_path is given) only tells which identical
+# destinations are its own copies, whose sources are moved to finish it. With a
+# Metrics, planning is timed as the "merge_plan" phase.
+def plan_merge(primary, folder, onerror=None, metrics=None, remove_identical=False, journal_path=None):
+    check_merge_folders(primary, folder)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    plan = MergePlan(primary, folder, remove_identical=remove_identical)
+    primary_device = device_of(primary)
+    unfinished = unfinished_moves(journal_path or default_journal_path(primary, folder), primary, folder)
+    stack = [""]
+    while stack:
+        relative_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(folder, relative_dir)) as iterator:
+                entries = list(iterator)
+        except OSError as e:
+            if onerror:
+                onerror(e)
+            continue
+
+        for entry in entries:
+            relative_path = os.path.join(relative_dir, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    plan.directories.append(relative_path)
+                    stack.append(relative_path)
+                    continue
+                source_stat = entry.stat(follow_symlinks=False)
+                destination = os.path.join(primary, relative_path)
+                try:
+                    destination_stat = os.lstat(destination)
+                except FileNotFoundError:
+                    destination_stat = None
+
+                move_action = "move" if source_stat.st_dev == primary_device else "copy"
+                if destination_stat is None:
+                    action = move_action
+                elif is_identical(entry.path, source_stat, destination, destination_stat):
+                    action = move_action if relative_path in unfinished else "identical"
+                else:
+                    action = "conflict"
+                plan.entries.append(MergeEntry(action, relative_path, source_stat.st_size))
+            except OSError as e:
+                if onerror:
+                    onerror(e)
+    if metrics:
+        metrics.add("merge_plan", time.perf_counter() - start_wall, time.process_time() - start_cpu, len(plan.entries))
+    return plan
+
+# Method to copy bytes between two open files with copy_file_range, then
+# sendfile, from their current positions. Returns the number of bytes copied,
+# which is less than size if neither is available for these files.
+def kernel_copy(source_fd, destination_fd, size):
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                count = os.copy_file_range(source_fd, destination_fd, min(size - copied, KERNEL_COPY_CHUNK))
+                if not count:
+                    break
+                copied += count
+            return copied
+        except OSError as e:
+            if copied or e.errno not in KERNEL_COPY_FALLBACK_ERRNOS:
+                raise
+    if hasattr(os, "sendfile"):
+        try:
+            while copied < size:
+                count = os.sendfile(destination_fd, source_fd, copied, min(size - copied, KERNEL_COPY_CHUNK))
+                if not count:
+                    break
+                copied += count
+        except OSError as e:
+            if copied or e.errno not in KERNEL_COPY_FALLBACK_ERRNOS:
+                raise
+    return copied
+
+# Method to copy a file's content, in the kernel where possible
+def copy_file(source, destination):
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        size = os.fstat(source_file.fileno()).st_size
+        copied = kernel_copy(source_file.fileno(), destination_file.fileno(), size)
+        if copied < size:
+            source_file.seek(copied)
+            destination_file.seek(copied)
+            shutil.copyfileobj(source_file, destination_file, READ_SIZE)
+
+# Method to move a file to another filesystem. The copy is written next to the
+# destination under a hidden name and renamed into place once complete, so an
+# interrupted copy never leaves a truncated file at the destination.
+def copy_and_remove(source, destination):
+    partial = os.path.join(os.path.dirname(destination), "." + os.path.basename(destination) + PARTIAL_SUFFIX)
+    try:
+        os.unlink(partial)
+    except FileNotFoundError:
+        pass
+    if os.path.islink(source):
+        os.symlink(os.readlink(source), partial)
+    else:
+        copy_file(source, partial)
+        shutil.copystat(source, partial)
+    os.rename(partial, destination)
+    os.unlink(source)
+
+# Method to carry out one entry of a plan on a worker thread and return its event
+def apply_entry(plan, entry):
+    source = plan.source(entry)
+    destination = plan.destination(entry)
+    # Removing or replacing a source that is its own destination would lose it
+    if is_same_entry(source, destination):
+        return {"action": "skipped", "source": source, "reason": "it is the same file as its destination"}
+    if entry.action == "identical":
+        if not os.path.lexists(source):
+            return {"action": "removed", "source": source, "destination": destination}
+        # Compared again right before deleting, the destination may have changed since planning
+        source_stat = os.lstat(source)
+        if not is_identical(source, source_stat, destination, os.lstat(destination)):
+            return {"action": "skipped", "source": source, "reason": "a different file already exists"}
+        os.unlink(source)
+        return {"action": "removed", "source": source, "destination": destination}
+
+    if not os.path.lexists(source) and os.path.lexists(destination):
+        # Already done by an interrupted run that did not get to journal it
+        return {"action": "moved", "source": source, "destination": destination}
+    if os.path.lexists(destination):
+        source_stat = os.lstat(source)
+        if not is_identical(source, source_stat, destination, os.lstat(destination)):
+            return {"action": "skipped", "source": source, "reason": "a different file already exists"}
+        # Copied by an interrupted run that did not get to remove the source
+        os.unlink(source)
+        return {"action": "moved", "source": source, "destination": destination}
+    if entry.action == "move":
+        try:
+            os.rename(source, destination)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            copy_and_remove(source, destination)
+    else:
+        copy_and_remove(source, destination)
+    return {"action": "moved", "source": source, "destination": destination}
+
+# Method to get the default journal location for merging folder into primary
+def default_journal_path(primary, folder):
+    key = hashlib.blake2b(f"{os.path.abspath(primary)}\0{os.path.abspath(folder)}".encode(), digest_size=8).hexdigest()
+    return os.path.join(os.path.dirname(default_index_path()), "merges", f"{key}.journal")
+
+# Method to write a plan to a new journal and return it opened for appending.
+# The journal holds a header, one JSON array per directory and entry, and then
+# the index of every entry once it is done.
+def create_journal(journal_path, plan):
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    temporary_path = journal_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as journal:
+        header = {"version": JOURNAL_VERSION, "primary": os.path.abspath(plan.primary), "folder": os.path.abspath(plan.folder),
+                  "directories": len(plan.directories), "entries": len(plan.entries)}
+        journal.write(json.dumps(header) + "\n")
+        for relative_dir in plan.directories:
+            journal.write(json.dumps(relative_dir) + "\n")
+        for entry in plan.entries:
+            journal.write(json.dumps(list(entry)) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+    # Renamed into place only once complete, so a journal always holds a whole plan
+    os.replace(temporary_path, journal_path)
+    return open(journal_path, "a", encoding="utf-8")
+
+# Method to load the plan and the indices of done entries from the journal of an
+# interrupted merge of folder into primary. Returns None if there is none.
+def load_journal(journal_path, primary, folder):
+    try:
+        with open(journal_path, encoding="utf-8") as journal:
+            header = json.loads(journal.readline())
+            if header.get("version") != JOURNAL_VERSION or header["primary"] != os.path.abspath(primary) or header["folder"] != os.path.abspath(folder):
+                return None
+            directories = [json.loads(journal.readline()) for _ in range(header["directories"])]
+            entries = [MergeEntry(*json.loads(journal.readline())) for _ in range(header["entries"])]
+            done = set()
+            for line in journal:
+                # The last line may be torn if the merge was killed while writing it
+                if line.endswith("\n"):
+                    done.add(int(line))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return MergePlan(primary, folder, entries, directories), done
+
+# Method to carry out a merge plan with parallel workers. Yields an event dict
+# for every action, see describe_merge_event. The plan is written to the
+# journal, if given, and done entries are appended to it. The journal is
+# removed once the merge finished without errors. With a Metrics, the time up
+# to each finished entry is added to the "merge" phase.
+def execute_merge(plan, workers=None, journal_path=None, metrics=None):
+    workers = workers or DEFAULT_MERGE_WORKERS
+    journal = None
+    if journal_path:
+        journal = create_journal(journal_path, plan)
+    errors = 0
+
+    try:
+        for relative_dir in plan.directories:
+            path = os.path.join(plan.primary, relative_dir)
+            try:
+                os.makedirs(path, exist_ok=True)
+            except OSError as e:
+                errors += 1
+                yield {"action": "error", "path": path, "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            try:
+                last_wall = time.perf_counter()
+                last_cpu = time.process_time()
+
+                def finished_events():
+                    nonlocal errors, last_wall, last_cpu
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        index, entry = pending.pop(future)
+                        if metrics:
+                            now_wall = time.perf_counter()
+                            now_cpu = time.process_time()
+                            metrics.add("merge", now_wall - last_wall, now_cpu - last_cpu, 1, entry.size if entry.action == "copy" else 0)
+                            last_wall, last_cpu = now_wall, now_cpu
+                        try:
+                            event = future.result()
+                        except OSError as e:
+                            errors += 1
+                            yield {"action": "error", "path": plan.source(entry), "error": str(e)}
+                            continue
+                        if journal:
+                            journal.write(f"{index}\n")
+                        yield event
+
+                for index, entry in enumerate(plan.entries):
+                    if entry.action == "conflict":
+                        yield {"action": "skipped", "source": plan.source(entry), "reason": "a different file already exists"}
+                        continue
+                    if entry.action == "identical" and not plan.remove_identical:
+                        yield {"action": "skipped", "source": plan.source(entry), "reason": "the same file already exists"}
+                        continue
+                    while len(pending) >= 4 * workers:
+                        yield from finished_events()
+                    pending[executor.submit(apply_entry, plan, entry)] = (index, entry)
+                while pending:
+                    yield from finished_events()
+            finally:
+                for future in pending:
+                    future.cancel()
+    finally:
+        if journal:
+            journal.close()
+
+    # Remove the folders emptied by the merge, deepest first
+    for relative_dir in reversed(plan.directories):
+        try:
+            os.rmdir(os.path.join(plan.folder, relative_dir))
+        except OSError:
+            pass
+    try:
+        os.rmdir(plan.folder)
+        yield {"action": "deleted", "path": plan.folder}
+    except OSError as e:
+        yield {"action": "error", "path": plan.folder, "error": f"could not delete folder (not empty or no permission): {e}"}
+
+    if journal_path and not errors:
+        os.remove(journal_path)
+
+# Method to move the contents of folder2 into folder1 and remove folder2.
+# Files that already exist in folder1 with the same content are left in place,
+# unless remove_identical is set. Every merge plans from the current tree, so
+# an interrupted merge of the same folders is resumed by running it again, see
+# plan_merge. Raises ValueError if the folders overlap. Yields an event dict for
+# every action, see describe_merge_event.
+def merge_folders(folder1, folder2, workers=None, journal_path=None, metrics=None, remove_identical=False):
+    journal_path = journal_path or default_journal_path(folder1, folder2)
+    plan = plan_merge(folder1, folder2, metrics=metrics, remove_identical=remove_identical, journal_path=journal_path)
+    yield from execute_merge(plan, workers, journal_path, metrics)
+
+# Method to turn a merge event into a line of text
+def describe_merge_event(event):
+    if event["action"] == "moved":
+        return f"Moved: {event['source']} -> {event['destination']}\n"
+    if event["action"] == "removed":
+        return f"Removed identical: {event['source']} (same as {event['destination']})\n"
+    if event["action"] == "skipped":
+        return f"Skipped ({event['reason']}): {event['source']}\n"
+    if event["action"] == "deleted":
+        return f"Deleted: {event['path']}\n"
+    return f"Error at {event['path']}: {event['error']}\n"
+
+# Method to turn a merge plan into a dry-run summary, listing the conflicts
+def describe_merge_plan(plan):
+    summary = plan.summary()
+    lines = [f"Merge {plan.folder} -> {plan.primary}:\n"]
+    labels = {"move": "Move", "copy": "Copy across devices", "identical": "Remove identical" if plan.remove_identical else "Identical (left in place)",
+              "conflict": "Conflicts (left in place)"}
+    for action in MERGE_ACTIONS:
+        lines.append(f"  {labels[action]}: {summary[action]['files']} files, {summary[action]['bytes']} bytes\n")
+    for entry in plan.entries:
+        if entry.action == "conflict":
+            lines.append(f"  Conflict: {plan.source(entry)}\n")
+    return "".join(lines)
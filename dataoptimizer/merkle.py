@@ -0,0 +1,69 @@
+import hashlib
+import os
+
+# Method to compute a Merkle hash for every folder of a scan, bottom-up.
+# directories is a list of (dirpath, dirnames, files) in the top-down order of
+# the scanner, where files is an iterable of (name, file_key, size). file_hash
+# returns the content digest (bytes) of a file key, or None for files known to
+# be unique, which make their folder unique too, as do subfolders that were not
+# scanned. Returns a dict of dirpath -> (digest, total_size, file_count).
+def compute_tree_hashes(directories, file_hash):
+    tree_hashes = {}
+    # Subfolders always come after their parent, so go through them in reverse
+    for dirpath, dirnames, files in reversed(directories):
+        entries = []
+        total_size = 0
+        file_count = 0
+        for name, file_key, size in files:
+            content_hash = file_hash(file_key)
+            content_key = content_hash if content_hash else b"unique\0" + os.fsencode(os.path.join(dirpath, name))
+            entries.append((b"f", os.fsencode(name), content_key))
+            total_size += size
+            file_count += 1
+        for name in dirnames:
+            subfolder = os.path.join(dirpath, name)
+            if subfolder in tree_hashes:
+                digest, size, count = tree_hashes[subfolder]
+                total_size += size
+                file_count += count
+            else:
+                digest = b"unique\0" + os.fsencode(subfolder)
+            entries.append((b"d", os.fsencode(name), digest))
+
+        hash_obj = hashlib.blake2b(digest_size=16)
+        for kind, name, key in sorted(entries):
+            hash_obj.update(kind + b"\0" + name + b"\0" + key + b"\0")
+        tree_hashes[dirpath] = (hash_obj.digest(), total_size, file_count)
+    return tree_hashes
+
+# Method to find the highest roots of identical folders. Folders with the same
+# Merkle hash form a group; a group is left out when its members are the same
+# subfolder of identical parents, one per parent, since the parents' group
+# already covers it. Empty folders are ignored. Returns (digest, total_size,
+# file_count, paths) per group, largest first.
+def find_duplicate_trees(tree_hashes, root):
+    folders_by_digest = {}
+    for dirpath, (digest, _, file_count) in tree_hashes.items():
+        if file_count:
+            folders_by_digest.setdefault(digest, []).append(dirpath)
+    duplicated = {digest for digest, paths in folders_by_digest.items() if len(paths) > 1}
+
+    # Parents in different duplicate groups (or twice the same parent) do not
+    # cover their subfolders, which then form a group of their own
+    def covered_by_parents(paths):
+        if root in paths:
+            return False
+        parents = {os.path.dirname(path) for path in paths}
+        if len(parents) < len(paths) or not all(parent in tree_hashes for parent in parents):
+            return False
+        return len({tree_hashes[parent][0] for parent in parents}) == 1
+
+    groups = []
+    for digest in duplicated:
+        paths = folders_by_digest[digest]
+        if covered_by_parents(paths):
+            continue
+        _, total_size, file_count = tree_hashes[paths[0]]
+        groups.append((digest, total_size, file_count, paths))
+    groups.sort(key=lambda group: group[1], reverse=True)
+    return groups
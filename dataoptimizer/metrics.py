@@ -0,0 +1,142 @@
+import cProfile
+import heapq
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Number of slowest directories kept by a Metrics
+DEFAULT_SLOWEST_DIRECTORIES = 10
+
+# Number of allocation sites written to a memory profile
+MEMORY_PROFILE_LINES = 50
+
+# Class to collect timings and counters of one run. Work is recorded per phase
+# (e.g. "list", "stat", "hash_full", "index") as wall time, CPU time of the
+# process, files (or other items, such as folders) and bytes; directories are
+# timed separately to find the slowest ones. All methods are safe to call from worker threads, and readers
+# such as the GUI can take a snapshot() while the run is going on.
+class Metrics:
+    def __init__(self, slowest_directories=DEFAULT_SLOWEST_DIRECTORIES):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.slowest_directories = slowest_directories
+        # Min-heap of (seconds, path), so the fastest of the slowest is replaced first
+        self.directories = []
+        self.started = time.perf_counter()
+
+    def add(self, phase, wall=0.0, cpu=0.0, files=0, bytes_read=0):
+        with self.lock:
+            totals = self.phases.get(phase)
+            if totals is None:
+                totals = self.phases[phase] = {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0, "files": 0, "bytes": 0}
+            totals["wall_seconds"] += wall
+            totals["cpu_seconds"] += cpu
+            totals["calls"] += 1
+            totals["files"] += files
+            totals["bytes"] += bytes_read
+
+    # Time the block as one call of a phase. files and bytes_read can be
+    # counted while the block runs through the yielded dict.
+    @contextmanager
+    def phase(self, name, files=0, bytes_read=0):
+        counts = {"files": files, "bytes": bytes_read}
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.perf_counter() - start_wall, time.process_time() - start_cpu, counts["files"], counts["bytes"])
+
+    def add_directory(self, path, seconds):
+        with self.lock:
+            if len(self.directories) < self.slowest_directories:
+                heapq.heappush(self.directories, (seconds, path))
+            elif seconds > self.directories[0][0]:
+                heapq.heapreplace(self.directories, (seconds, path))
+
+    # Copy of the current state with the rates per phase, safe to serialize
+    def snapshot(self):
+        with self.lock:
+            phases = {name: dict(totals) for name, totals in self.phases.items()}
+            directories = sorted(self.directories, reverse=True)
+        for totals in phases.values():
+            wall = totals["wall_seconds"]
+            totals["files_per_second"] = totals["files"] / wall if wall else 0.0
+            totals["mb_per_second"] = totals["bytes"] / wall / (1024 * 1024) if wall else 0.0
+        return {
+            "elapsed_seconds": time.perf_counter() - self.started,
+            "phases": phases,
+            "slowest_directories": [{"path": path, "seconds": seconds} for seconds, path in directories],
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    # Snapshot in the Prometheus text exposition format
+    def to_prometheus(self, prefix="dataoptimizer"):
+        snapshot = self.snapshot()
+        metrics = [
+            ("phase_wall_seconds_total", "counter", "Wall time spent per phase", "wall_seconds"),
+            ("phase_cpu_seconds_total", "counter", "Process CPU time spent per phase", "cpu_seconds"),
+            ("phase_calls_total", "counter", "Number of timed calls per phase", "calls"),
+            ("phase_files_total", "counter", "Files processed per phase", "files"),
+            ("phase_bytes_total", "counter", "Bytes read per phase", "bytes"),
+        ]
+        lines = [
+            f"# HELP {prefix}_elapsed_seconds Time since the run started",
+            f"# TYPE {prefix}_elapsed_seconds gauge",
+            f"{prefix}_elapsed_seconds {snapshot['elapsed_seconds']}",
+        ]
+        for name, metric_type, help_text, key in metrics:
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {metric_type}")
+            for phase, totals in sorted(snapshot["phases"].items()):
+                lines.append(f'{prefix}_{name}{{phase="{escape_label(phase)}"}} {totals[key]}')
+        lines.append(f"# HELP {prefix}_directory_seconds Time spent listing and stat-ing the slowest directories")
+        lines.append(f"# TYPE {prefix}_directory_seconds gauge")
+        for directory in snapshot["slowest_directories"]:
+            lines.append(f'{prefix}_directory_seconds{{path="{escape_label(directory["path"])}"}} {directory["seconds"]}')
+        return "\n".join(lines) + "\n"
+
+    # Snapshot as lines of text for display
+    def describe(self):
+        snapshot = self.snapshot()
+        lines = [f"Elapsed: {snapshot['elapsed_seconds']:.2f} s\n"]
+        for phase, totals in snapshot["phases"].items():
+            lines.append(f"{phase}: {totals['wall_seconds']:.2f} s wall, {totals['cpu_seconds']:.2f} s CPU, "
+                         f"{totals['files']} files ({totals['files_per_second']:.0f}/s), "
+                         f"{totals['bytes'] / (1024 * 1024):.1f} MB ({totals['mb_per_second']:.1f} MB/s)\n")
+        if snapshot["slowest_directories"]:
+            lines.append("Slowest directories:\n")
+            for directory in snapshot["slowest_directories"]:
+                lines.append(f"  {directory['seconds'] * 1000:.1f} ms  {directory['path']}\n")
+        return lines
+
+# Method to escape a Prometheus label value
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+# Context manager to profile the block. The cProfile data of the calling thread
+# is written to profile_path (open it with pstats or snakeviz); with
+# trace_memory, the largest allocation sites are written to profile_path + ".memory.txt".
+@contextmanager
+def profiled(profile_path, trace_memory=False):
+    profiler = cProfile.Profile()
+    if trace_memory:
+        tracemalloc.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        if trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(profile_path + ".memory.txt", "w") as f:
+                f.write(f"Peak traced memory: {peak} bytes\n")
+                for statistic in snapshot.statistics("lineno")[:MEMORY_PROFILE_LINES]:
+                    f.write(f"{statistic}\n")
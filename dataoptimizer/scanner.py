@@ -0,0 +1,385 @@
+import os
+import queue
+import statistics
+import threading
+import time
+from collections import deque, namedtuple
+from fnmatch import fnmatch
+
+# Compact record of a scanned file, built from a single DirEntry.stat() call
+FileRecord = namedtuple("FileRecord", ["path", "name", "size", "mtime_ns", "device", "inode"])
+
+# Filesystem types whose metadata calls go over the network
+NETWORK_FILESYSTEMS = {
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "fuse.glusterfs",
+    "fuse.sshfs", "fuse.rclone", "fuse.s3fs", "davfs", "lustre", "gpfs", "beegfs",
+}
+
+# Most directories and files listed and stat-ed at once by a concurrent walk
+MAX_CONCURRENCY = 64
+
+# Fewest workers used on a network filesystem, even if it answered quickly while
+# tuning (e.g. from its attribute cache)
+MIN_NETWORK_CONCURRENCY = 4
+
+# Number of stat calls timed to tune the concurrency of a mount
+LATENCY_SAMPLES = 32
+
+# Files of one directory stat-ed by a single task of a concurrent walk, so
+# large directories are spread over the workers
+STAT_BATCH_SIZE = 256
+
+# Tuned concurrency per device, see tune_concurrency
+_concurrency_by_device = {}
+_concurrency_lock = threading.Lock()
+
+# Method to check a name or a relative path against a list of glob patterns
+def matches_any(name, relative_path, patterns):
+    return any(fnmatch(name, pattern) or fnmatch(relative_path, pattern) for pattern in patterns)
+
+# Method to walk a folder in a single os.scandir pass. Yields (dirpath, dirnames, files)
+# top-down like os.walk, where files is a list of FileRecords. Removing names from
+# dirnames prunes the walk. Include patterns select files, exclude patterns drop
+# files and whole folders. Folders deeper than max_depth below the root are not
+# entered. Symlinks are skipped unless follow_symlinks is set. With a Metrics,
+# listing and stat-ing are timed as the "list" and "stat" phases, per directory;
+# CPU time is that of the thread doing the work, so workers of a concurrent walk
+# do not count each other's.
+# concurrency is the number of directories listed and files stat-ed at once; by
+# default it is tuned for the mount the folder is on (see tune_concurrency),
+# which scans local disks one call at a time. With a concurrency above 1,
+# folders still come after their parent, but siblings may come in any order.
+def walk(root, include=None, exclude=None, max_depth=None, follow_symlinks=False, onerror=None, metrics=None, concurrency=None):
+    if concurrency is None:
+        concurrency = tune_concurrency(root, metrics)
+    if concurrency > 1:
+        yield from walk_concurrent(root, include, exclude, max_depth, follow_symlinks, onerror, metrics, concurrency)
+        return
+
+    visited = set()
+    if follow_symlinks:
+        try:
+            stat = os.stat(root)
+            visited.add((stat.st_dev, stat.st_ino))
+        except OSError:
+            pass
+    stack = [(root, 0)]
+    while stack:
+        dirpath, depth = stack.pop()
+        start_wall = time.perf_counter()
+        entries = list_directory(dirpath, onerror, metrics)
+        if entries is None:
+            continue
+        listed_wall = time.perf_counter()
+        listed_cpu = time.thread_time()
+        dirnames, file_entries = split_entries(entries, root, include, exclude, follow_symlinks, onerror)
+        files = stat_entries(file_entries, onerror)
+        if metrics:
+            end_wall = time.perf_counter()
+            metrics.add("stat", end_wall - listed_wall, time.thread_time() - listed_cpu, len(files))
+            metrics.add_directory(dirpath, end_wall - start_wall)
+
+        yield dirpath, dirnames, files
+
+        if max_depth is not None and depth >= max_depth:
+            continue
+        for path in reversed(subfolders_to_walk(dirpath, dirnames, follow_symlinks, visited, onerror)):
+            stack.append((path, depth + 1))
+
+# Method to list a directory, timed as the "list" phase. Returns None if it cannot be listed.
+def list_directory(dirpath, onerror, metrics):
+    if metrics:
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+    try:
+        with os.scandir(dirpath) as iterator:
+            entries = list(iterator)
+    except OSError as e:
+        if onerror:
+            onerror(e)
+        return None
+    if metrics:
+        metrics.add("list", time.perf_counter() - start_wall, time.thread_time() - start_cpu, len(entries))
+    return entries
+
+# Method to sort the entries of a directory into subfolder names and the
+# DirEntries of files to stat, applying the include and exclude patterns
+def split_entries(entries, root, include, exclude, follow_symlinks, onerror):
+    dirnames = []
+    file_entries = []
+    for entry in entries:
+        try:
+            if not follow_symlinks and entry.is_symlink():
+                continue
+            relative_path = os.path.relpath(entry.path, root)
+            if exclude and matches_any(entry.name, relative_path, exclude):
+                continue
+            if entry.is_dir():
+                dirnames.append(entry.name)
+            elif entry.is_file():
+                if include and not matches_any(entry.name, relative_path, include):
+                    continue
+                file_entries.append(entry)
+        except OSError as e:
+            if onerror:
+                onerror(e)
+    return dirnames, file_entries
+
+# Method to stat DirEntries of files and return their FileRecords
+def stat_entries(file_entries, onerror):
+    files = []
+    for entry in file_entries:
+        try:
+            stat = entry.stat()
+        except OSError as e:
+            if onerror:
+                onerror(e)
+            continue
+        files.append(FileRecord(entry.path, entry.name, stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino))
+    return files
+
+# Method to get the paths of the subfolders to walk next, skipping symlink loops
+def subfolders_to_walk(dirpath, dirnames, follow_symlinks, visited, onerror):
+    paths = []
+    for name in dirnames:
+        path = os.path.join(dirpath, name)
+        if follow_symlinks:
+            # Guard against symlink loops
+            try:
+                stat = os.stat(path)
+            except OSError as e:
+                if onerror:
+                    onerror(e)
+                continue
+            if (stat.st_dev, stat.st_ino) in visited:
+                continue
+            visited.add((stat.st_dev, stat.st_ino))
+        paths.append(path)
+    return paths
+
+# Method to find the filesystem type of the mount a path is on, from
+# /proc/mounts. Returns None where that is not available.
+def filesystem_type(path):
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best_mount, best_type = "", None
+    for mount_point, fs_type in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) > len(best_mount):
+            best_mount, best_type = mount_point, fs_type
+    return best_type
+
+# Method to time metadata calls on a folder. Lists it and stats up to
+# LATENCY_SAMPLES of its entries one after another, and returns the median wall
+# time and the mean CPU time of a call in seconds, or None if nothing could be timed.
+def measure_latency(path):
+    wall_times = []
+    start_cpu = time.thread_time()
+    try:
+        start_wall = time.perf_counter()
+        with os.scandir(path) as iterator:
+            names = [entry.name for _, entry in zip(range(LATENCY_SAMPLES), iterator)]
+        wall_times.append(time.perf_counter() - start_wall)
+    except OSError:
+        return None
+    for name in names:
+        start_wall = time.perf_counter()
+        try:
+            os.stat(os.path.join(path, name), follow_symlinks=False)
+        except OSError:
+            continue
+        wall_times.append(time.perf_counter() - start_wall)
+    cpu = (time.thread_time() - start_cpu) / len(wall_times)
+    return statistics.median(wall_times), cpu
+
+# Method to pick how many metadata calls to run at once on the mount a folder is
+# on. Local filesystems answer faster than a thread switch and are walked one
+# call at a time. On network filesystems (and where the type is unknown), calls
+# mostly wait on the network: they are timed, and as many workers are used as
+# it takes to keep the CPU busy while others wait, i.e. the wall time of a call
+# over its CPU time. The result is kept per device, so each mount is tuned once.
+def tune_concurrency(path, metrics=None):
+    try:
+        device = os.stat(path).st_dev
+    except OSError:
+        return 1
+    with _concurrency_lock:
+        if device in _concurrency_by_device:
+            return _concurrency_by_device[device]
+
+    fs_type = filesystem_type(path)
+    concurrency = 1
+    if fs_type is None or fs_type in NETWORK_FILESYSTEMS:
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        latency = measure_latency(path)
+        if latency:
+            wall, cpu = latency
+            # A CPU time of 0 means the clock is too coarse, count it as 10 µs
+            concurrency = max(1, min(MAX_CONCURRENCY, round(wall / max(cpu, 1e-5))))
+        if fs_type:
+            # Attribute caches can make a network mount look fast while tuning
+            concurrency = max(concurrency, MIN_NETWORK_CONCURRENCY)
+        if metrics:
+            metrics.add("tune", time.perf_counter() - start_wall, time.thread_time() - start_cpu, LATENCY_SAMPLES)
+
+    with _concurrency_lock:
+        _concurrency_by_device[device] = concurrency
+    return concurrency
+
+# Class for a work-stealing task queue. Every worker has its own deque and takes
+# its newest task first, which keeps it in the subtree it just listed; an idle
+# worker steals the oldest task of another worker, which is usually the
+# largest subtree left.
+class WorkStealingQueue:
+    def __init__(self, workers):
+        self.deques = [deque() for _ in range(workers)]
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def push(self, worker, task):
+        with self.condition:
+            self.deques[worker].append(task)
+            self.condition.notify()
+
+    # Take a task for a worker, waiting until there is one. Returns None once closed.
+    def pop(self, worker):
+        with self.condition:
+            while not self.closed:
+                if self.deques[worker]:
+                    return self.deques[worker].pop()
+                for offset in range(1, len(self.deques)):
+                    victim = self.deques[(worker + offset) % len(self.deques)]
+                    if victim:
+                        return victim.popleft()
+                self.condition.wait()
+            return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+# Class for a directory of a concurrent walk whose files are stat-ed in batches
+# by several workers. The last batch to finish reports the directory.
+class PendingDirectory:
+    def __init__(self, dirpath, depth, dirnames, batches, worker, elapsed):
+        self.dirpath = dirpath
+        self.depth = depth
+        self.dirnames = dirnames
+        self.batches = [None] * batches
+        self.remaining = batches
+        self.worker = worker
+        self.elapsed = elapsed
+        self.lock = threading.Lock()
+
+    # Store the FileRecords of one batch and return True when all batches are done
+    def finish_batch(self, batch, files, elapsed):
+        with self.lock:
+            self.batches[batch] = files
+            self.elapsed += elapsed
+            self.remaining -= 1
+            return self.remaining == 0
+
+    def files(self):
+        return [record for files in self.batches for record in files]
+
+# Method to walk a folder with a pool of workers that list directories and stat
+# files concurrently, see walk. The calling thread yields each directory and
+# only then queues its subfolders, so pruning dirnames works as with a
+# sequential walk and every folder comes after its parent.
+def walk_concurrent(root, include, exclude, max_depth, follow_symlinks, onerror, metrics, concurrency):
+    tasks = WorkStealingQueue(concurrency)
+    # (dirpath, depth, dirnames, files, worker), None for a directory that
+    # could not be listed, or an exception raised by a worker
+    results = queue.Queue()
+
+    def list_task(worker, dirpath, depth):
+        start_wall = time.perf_counter()
+        entries = list_directory(dirpath, onerror, metrics)
+        if entries is None:
+            results.put(None)
+            return
+        listed_wall = time.perf_counter()
+        listed_cpu = time.thread_time()
+        dirnames, file_entries = split_entries(entries, root, include, exclude, follow_symlinks, onerror)
+        if len(file_entries) > STAT_BATCH_SIZE:
+            batches = [file_entries[i:i + STAT_BATCH_SIZE] for i in range(0, len(file_entries), STAT_BATCH_SIZE)]
+            pending = PendingDirectory(dirpath, depth, dirnames, len(batches), worker, listed_wall - start_wall)
+            for batch, batch_entries in enumerate(batches):
+                tasks.push(worker, ("stat", pending, batch, batch_entries))
+            return
+        files = stat_entries(file_entries, onerror)
+        if metrics:
+            end_wall = time.perf_counter()
+            metrics.add("stat", end_wall - listed_wall, time.thread_time() - listed_cpu, len(files))
+            metrics.add_directory(dirpath, end_wall - start_wall)
+        results.put((dirpath, depth, dirnames, files, worker))
+
+    def stat_task(pending, batch, batch_entries):
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        files = stat_entries(batch_entries, onerror)
+        elapsed = time.perf_counter() - start_wall
+        if metrics:
+            metrics.add("stat", elapsed, time.thread_time() - start_cpu, len(files))
+        if pending.finish_batch(batch, files, elapsed):
+            if metrics:
+                metrics.add_directory(pending.dirpath, pending.elapsed)
+            results.put((pending.dirpath, pending.depth, pending.dirnames, pending.files(), pending.worker))
+
+    def work(worker):
+        while True:
+            task = tasks.pop(worker)
+            if task is None:
+                return
+            try:
+                if task[0] == "list":
+                    list_task(worker, task[1], task[2])
+                else:
+                    stat_task(*task[1:])
+            except BaseException as e:
+                results.put(e)
+
+    visited = set()
+    if follow_symlinks:
+        try:
+            stat = os.stat(root)
+            visited.add((stat.st_dev, stat.st_ino))
+        except OSError:
+            pass
+    threads = [threading.Thread(target=work, args=(worker,), daemon=True) for worker in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        tasks.push(0, ("list", root, 0))
+        outstanding = 1
+        while outstanding:
+            result = results.get()
+            outstanding -= 1
+            if isinstance(result, BaseException):
+                raise result
+            if result is None:
+                continue
+            dirpath, depth, dirnames, files, worker = result
+
+            yield dirpath, dirnames, files
+
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for path in subfolders_to_walk(dirpath, dirnames, follow_symlinks, visited, onerror):
+                tasks.push(worker, ("list", path, depth + 1))
+                outstanding += 1
+    finally:
+        tasks.close()
+        for thread in threads:
+            thread.join()
+
+# Method to yield the FileRecords of every file below a folder
+def scan_files(root, **options):
+    for _, _, files in walk(root, **options):
+        yield from files
@@ -0,0 +1,202 @@
+import gzip
+import hashlib
+import heapq
+import json
+import os
+import re
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .duplicates import DuplicateFinder
+from .filetable import FileTable
+from .hashing import HashEngine
+from .index import INDEX_COMMIT_INTERVAL, FileIndex
+from .scanner import walk
+
+SHARD_VERSION = 1
+
+SHARD_SUFFIX = ".shard.jsonl.gz"
+
+# Method to get the file name of the shard of a root on a host. The readable
+# slug of the root is followed by a short hash of its absolute path, since
+# different roots can have the same slug (e.g. /srv/disk_1 and /srv/disk/1).
+def shard_name(host, root):
+    root = os.path.abspath(root)
+    slug = re.sub(r"[^A-Za-z0-9._-]+", "_", root.strip(os.sep)) or "root"
+    key = hashlib.blake2b(os.fsencode(root), digest_size=4).hexdigest()
+    return f"{host}-{slug}-{key}{SHARD_SUFFIX}"
+
+# Method to scan a folder and write a shard: a self-contained, portable file of
+# every file's size and full hash, sorted by (size, hash, path), so shards of
+# other roots and hosts can be merged without access to their files (see
+# merge_shards). Unlike DuplicateFinder, every file at least min_size bytes
+# large is hashed, since its duplicates may be in another shard. Hashes are
+# reused from the index where files are unchanged. The shard is a gzip
+# compressed JSON line of header, then one [size, hash, path] array per file.
+# Returns the header.
+def write_shard(folder, shard_path, engine=None, index=None, host=None, min_size=0, progress=None, metrics=None, **scan_options):
+    folder = os.path.abspath(folder)
+    engine = engine or HashEngine.for_path(folder)
+    shard_path = os.path.abspath(shard_path)
+    table = FileTable(engine.algorithm)
+    finder = DuplicateFinder(engine, index, progress, metrics, scan_options.get("onerror"))
+    if index:
+        index.begin_scan(folder, engine.algorithm)
+
+    to_hash = []
+    last_commit = time.monotonic()
+    for dirpath, _, files in walk(folder, metrics=metrics, **scan_options):
+        for record in files:
+            if record.size < min_size or record.path.startswith(shard_path) or (index and index.is_index_file(record.path)):
+                continue
+            row = table.add(dirpath, record.name, record.size, record.mtime_ns)
+            full_hash = finder.record_in_index(index, record)[1] if index else None
+            if full_hash:
+                table.set_full_digest(row, full_hash)
+            else:
+                to_hash.append(row)
+            if progress:
+                progress("scan", len(table), None)
+            if index and time.monotonic() - last_commit >= INDEX_COMMIT_INTERVAL:
+                index.commit()
+                last_commit = time.monotonic()
+    if index:
+        index.commit()
+    finder.hash_with_progress(engine, table, to_hash, "full")
+    if index:
+        with finder.timed("index"):
+            index.finish_scan()
+
+    rows = list(sorted_rows(table))
+    header = {
+        "version": SHARD_VERSION,
+        "host": host or socket.gethostname(),
+        "root": folder,
+        "algorithm": engine.algorithm,
+        "created_at": time.time(),
+        "files": len(rows),
+        "bytes": sum(table.sizes[row] for row in rows),
+    }
+    os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+    temporary_path = shard_path + ".tmp"
+    with finder.timed("shard_write"), gzip.open(temporary_path, "wt", encoding="utf-8") as shard:
+        shard.write(json.dumps(header) + "\n")
+        for row in rows:
+            shard.write(json.dumps([table.sizes[row], table.full_digest(row).hex(), table.path(row)]) + "\n")
+    # Renamed into place only once complete, so a shard is never read half written
+    os.replace(temporary_path, shard_path)
+    return header
+
+# Method to yield the rows of a file table sorted by (size, hash, path), leaving
+# out rows without a full hash (files that could not be read). Rows are sorted
+# by size first and then each size on its own, so digests and paths are only
+# held for one size at a time.
+def sorted_rows(table):
+    rows = sorted((row for row in range(len(table)) if table.full_slots[row] >= 0), key=table.sizes.__getitem__)
+    start = 0
+    while start < len(rows):
+        end = start + 1
+        size = table.sizes[rows[start]]
+        while end < len(rows) and table.sizes[rows[end]] == size:
+            end += 1
+        if end - start == 1:
+            yield rows[start]
+        else:
+            yield from sorted(rows[start:end], key=lambda row: (table.full_digest(row), table.path(row)))
+        start = end
+
+# Method to write a shard for each of several roots, scanning them in parallel,
+# e.g. one root per local disk. Each scan gets its own engine for the storage
+# its root is on and its own connection to the index at index_path, unless
+# use_index is False. Yields the header of each shard as it is written, with its
+# path under "shard".
+def write_shards(roots, output_dir, host=None, use_index=True, index_path=None, min_size=0, engine_options=None, metrics=None, **scan_options):
+    host = host or socket.gethostname()
+
+    def scan_root(root):
+        index = None
+        if use_index:
+            index = FileIndex(index_path)
+        try:
+            shard_path = os.path.join(output_dir, shard_name(host, root))
+            engine = HashEngine.for_path(root, **(engine_options or {}))
+            header = write_shard(root, shard_path, engine, index, host, min_size, metrics=metrics, **scan_options)
+            return {"shard": shard_path, **header}
+        finally:
+            if index:
+                index.close()
+
+    with ThreadPoolExecutor(max_workers=len(roots) or 1) as executor:
+        futures = [executor.submit(scan_root, root) for root in roots]
+        for future in as_completed(futures):
+            yield future.result()
+
+# Method to read a shard. Returns its header and a generator of (size, hash,
+# path) entries, which raises ValueError if the shard is not sorted.
+def read_shard(shard_path):
+    shard = gzip.open(shard_path, "rt", encoding="utf-8")
+    try:
+        header = json.loads(shard.readline())
+    except (OSError, ValueError) as e:
+        shard.close()
+        raise ValueError(f"{shard_path} is not a shard: {e}")
+    if not isinstance(header, dict) or header.get("version") != SHARD_VERSION:
+        shard.close()
+        raise ValueError(f"{shard_path} is not a shard of version {SHARD_VERSION}")
+
+    def entries():
+        with shard:
+            previous = None
+            for line in shard:
+                size, file_hash, path = json.loads(line)
+                if previous and (size, file_hash) < previous:
+                    raise ValueError(f"{shard_path} is not sorted at {path}")
+                previous = (size, file_hash)
+                yield size, file_hash, path
+
+    return header, entries()
+
+# Method to tag the entries of a shard with its number, for merge_shards
+def tag_entries(entries, shard_number):
+    for size, file_hash, path in entries:
+        yield size, file_hash, shard_number, path
+
+# Method to find duplicates across shards, e.g. of several roots and hosts, in a
+# streaming k-way merge: only one entry per shard and the current group are in
+# memory, however large the shards are. All shards must use the same hash
+# algorithm. Yields a dict per group of files with the same size and hash, with
+# the host, root and path of every copy.
+def merge_shards(shard_paths):
+    headers = []
+    readers = []
+    streams = []
+    try:
+        for shard_number, shard_path in enumerate(shard_paths):
+            header, entries = read_shard(shard_path)
+            headers.append(header)
+            readers.append(entries)
+            streams.append(tag_entries(entries, shard_number))
+        algorithms = {header["algorithm"] for header in headers}
+        if len(algorithms) > 1:
+            raise ValueError(f"Shards use different hash algorithms ({', '.join(sorted(algorithms))}), write them with the same one")
+
+        group_key = None
+        group = []
+        seen = set()
+        for size, file_hash, shard_number, path in heapq.merge(*streams, key=lambda entry: (entry[0], entry[1])):
+            if (size, file_hash) != group_key:
+                if len(group) > 1:
+                    yield {"size": group_key[0], "hash": group_key[1], "files": group}
+                group_key = (size, file_hash)
+                group = []
+                seen = set()
+            header = headers[shard_number]
+            # Overlapping roots or a shard given twice list the same file again
+            if (header["host"], path) not in seen:
+                seen.add((header["host"], path))
+                group.append({"host": header["host"], "root": header["root"], "path": path})
+        if len(group) > 1:
+            yield {"size": group_key[0], "hash": group_key[1], "files": group}
+    finally:
+        for entries in readers:
+            entries.close()
@@ -0,0 +1,167 @@
+import hashlib
+import os
+from array import array
+from collections import defaultdict
+from contextlib import nullcontext
+from .folders import is_folder_count_similar
+from .scanner import walk
+
+# Number of MinHash slots per folder signature
+DEFAULT_NUM_SLOTS = 256
+
+# Default probability with which a pair at the lowest possible Jaccard
+# similarity for the threshold must still become a candidate. More similar
+# pairs become candidates with a higher probability.
+TARGET_RECALL = 0.95
+
+# Smallest ratio between the element counts of two folders that can pass
+# is_folder_count_similar
+MIN_COUNT_RATIO = 0.75
+
+# Method to hash a folder element (a relative subpath) to a 64-bit integer
+def element_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8", "surrogateescape"), digest_size=8).digest(), "big")
+
+# Method to build a MinHash signature from 64-bit element hashes in a single pass.
+# Uses one-permutation hashing: each hash lands in one slot, which keeps its
+# minimum. Empty slots take the value of the next non-empty slot to the right,
+# offset by the distance, so signatures of sparse sets stay comparable.
+def minhash_signature(hashes, num_slots=DEFAULT_NUM_SLOTS):
+    slots = [None] * num_slots
+    for element in hashes:
+        slot = element % num_slots
+        value = element // num_slots
+        if slots[slot] is None or value < slots[slot]:
+            slots[slot] = value
+    if all(value is None for value in slots):
+        return tuple([-1] * num_slots)
+
+    offset = (1 << 64) // num_slots + 1
+    signature = list(slots)
+    next_value = None
+    distance = 0
+    # Two rounds from right to left, so empty slots at the end wrap around
+    for i in range(2 * num_slots - 1, -1, -1):
+        slot = i % num_slots
+        if slots[slot] is not None:
+            next_value = slots[slot]
+            distance = 0
+        else:
+            distance += 1
+            if i < num_slots:
+                signature[slot] = next_value + distance * offset
+    return tuple(signature)
+
+# Method to estimate the Jaccard similarity of two sets from their signatures
+def estimate_jaccard(signature1, signature2):
+    return sum(a == b for a, b in zip(signature1, signature2)) / len(signature1)
+
+# Method to pick (bands, rows) for locality-sensitive hashing. Uses as many rows
+# per band as possible, which keeps unrelated pairs out, as long as a pair at
+# min_jaccard still shares a band with probability recall.
+def choose_bands(num_slots, min_jaccard, recall=TARGET_RECALL):
+    bands, rows = num_slots, 1
+    for candidate_rows in range(2, num_slots + 1):
+        candidate_bands = num_slots // candidate_rows
+        if 1 - (1 - min_jaccard ** candidate_rows) ** candidate_bands < recall:
+            break
+        bands, rows = candidate_bands, candidate_rows
+    return bands, rows
+
+# Method to get the lowest Jaccard similarity two folders can have when their
+# matching percentage (see calculate_similarity_percentage) reaches threshold
+def min_jaccard_for_threshold(threshold):
+    overlap = min(threshold, 100) / 100
+    return overlap / (1 + 1 / MIN_COUNT_RATIO - overlap)
+
+# Method to collect the hashed elements of every subfolder of a path in a single
+# walk. Elements are the relative subpaths of all folders below each subfolder,
+# plus the relative file paths (and sizes) if include_files (and include_sizes)
+# is set. Returns a dict of subfolder -> array of element hashes.
+def collect_folder_elements(path, include_files=False, include_sizes=False, progress=None, **scan_options):
+    elements = {}
+    for root, dirs, files in walk(path, **scan_options):
+        relative_root = os.path.relpath(root, path)
+        if relative_root == ".":
+            for folder in dirs:
+                elements[os.path.join(path, folder)] = array("Q")
+            continue
+        top_folder = os.path.join(path, relative_root.split(os.sep)[0])
+        folder_elements = elements[top_folder]
+        relative_path = os.path.relpath(root, top_folder)
+        folder_elements.append(element_hash(relative_path))
+        if include_files:
+            for record in files:
+                element = os.path.join(relative_path, record.name)
+                if include_sizes:
+                    element += f"\0{record.size}"
+                folder_elements.append(element_hash(element))
+        if progress:
+            progress(len(elements))
+    return elements
+
+# Method to find groups of subfolders of a path with a similar structure. A
+# MinHash signature per subfolder and locality-sensitive hashing find candidate
+# pairs in close to linear time; only candidates get the exact check of
+# is_folder_count_similar and calculate_similarity_percentage against threshold.
+# The result is approximate: every reported pair is similar, but a similar pair
+# is only found with probability recall (at least, more for more similar pairs),
+# so a few pairs the pairwise comparison finds can be missed. A higher recall
+# finds more of them at the cost of more candidates to check. Groups are
+# yielded in the pairwise comparison's format: every subfolder with at least one
+# similar subfolder after it, followed by those subfolders. With a Metrics, the
+# walk and the "signatures", "lsh" and "compare" phases are timed.
+def find_similar_folders(path, threshold=60, progress=None, include_files=False, include_sizes=False, num_slots=DEFAULT_NUM_SLOTS, metrics=None,
+                         recall=TARGET_RECALL, **scan_options):
+    if not 0 < recall <= 1:
+        raise ValueError(f"recall must be above 0 and at most 1, not {recall}")
+
+    def report_scan(folder_count):
+        if progress:
+            progress(0, folder_count)
+
+    def timed(phase):
+        return metrics.phase(phase) if metrics else nullcontext({})
+
+    elements = collect_folder_elements(path, include_files, include_sizes, report_scan, metrics=metrics, **scan_options)
+    all_folders = list(elements)
+    signatures = []
+    with timed("signatures") as counts:
+        for i, folder in enumerate(all_folders):
+            signatures.append(minhash_signature(elements[folder], num_slots))
+            if progress:
+                progress(i + 1, len(all_folders))
+        counts["files"] = len(all_folders)
+
+    bands, rows = choose_bands(num_slots, min_jaccard_for_threshold(threshold), recall)
+    candidates = set()
+    with timed("lsh"):
+        for band in range(bands):
+            buckets = defaultdict(list)
+            for i, signature in enumerate(signatures):
+                buckets[signature[band * rows:(band + 1) * rows]].append(i)
+            for bucket in buckets.values():
+                for position, i in enumerate(bucket):
+                    for j in bucket[position + 1:]:
+                        candidates.add((i, j))
+
+    element_sets = {}
+    similar = defaultdict(list)
+    with timed("compare") as counts:
+        for i, j in sorted(candidates):
+            if not is_folder_count_similar(elements[all_folders[i]], elements[all_folders[j]]):
+                continue
+            for k in (i, j):
+                if k not in element_sets:
+                    element_sets[k] = set(elements[all_folders[k]])
+            set1, set2 = element_sets[i], element_sets[j]
+            if not set1 or not set2:
+                similarity = 100 if set1 == set2 else 0
+            else:
+                similarity = len(set1 & set2) / min(len(set1), len(set2)) * 100
+            if similarity >= threshold:
+                similar[i].append(j)
+        counts["files"] = len(candidates)
+
+    for i in sorted(similar):
+        yield [all_folders[i]] + [all_folders[j] for j in similar[i]]
@@ -0,0 +1,77 @@
+import heapq
+import os
+from collections import defaultdict
+from .scanner import walk
+
+# Default number of largest files kept by a size report
+DEFAULT_TOP_K = 1000
+
+# Class to collect size statistics of a tree in a single pass with bounded
+# memory: the top_k largest files (kept in a min-heap, none if top_k is 0), a
+# histogram with one bucket per power of two and the total size of the files
+# directly in each folder.
+class SizeReport:
+    def __init__(self, root, top_k=DEFAULT_TOP_K):
+        self.root = root
+        self.top_k = top_k
+        self.heap = []
+        # Bucket i holds files with 2 ** (i - 1) <= size < 2 ** i, bucket 0 empty files
+        self.histogram_counts = defaultdict(int)
+        self.histogram_sizes = defaultdict(int)
+        self.directory_sizes = {}
+        self.file_count = 0
+        self.total_size = 0
+
+    # Add the FileRecords found directly in one folder
+    def add_directory(self, dirpath, files):
+        directory_size = 0
+        for record in files:
+            size = record.size
+            directory_size += size
+            bucket = size.bit_length()
+            self.histogram_counts[bucket] += 1
+            self.histogram_sizes[bucket] += size
+            if len(self.heap) < self.top_k:
+                heapq.heappush(self.heap, (size, record.path))
+            elif self.heap and size > self.heap[0][0]:
+                heapq.heapreplace(self.heap, (size, record.path))
+        self.directory_sizes[dirpath] = directory_size
+        self.file_count += len(files)
+        self.total_size += directory_size
+
+    # Return the largest files as (path, size), largest first
+    def largest_files(self):
+        return [(path, size) for size, path in sorted(self.heap, reverse=True)]
+
+    # Return (low, high, file_count, total_size) for every non-empty bucket,
+    # where files in a bucket have low <= size < high
+    def histogram(self):
+        buckets = []
+        for bucket in sorted(self.histogram_counts):
+            low = 0 if bucket == 0 else 1 << (bucket - 1)
+            high = 1 << bucket
+            buckets.append((low, high, self.histogram_counts[bucket], self.histogram_sizes[bucket]))
+        return buckets
+
+    # Return (path, size) for every folder, largest first. Sizes include all
+    # subfolders unless cumulative is False.
+    def directory_totals(self, cumulative=True):
+        totals = dict(self.directory_sizes)
+        if cumulative:
+            # Deepest folders first, so each total is complete before it is added to its parent
+            for dirpath in sorted(totals, key=len, reverse=True):
+                parent = os.path.dirname(dirpath)
+                if dirpath != self.root and parent in totals:
+                    totals[parent] += totals[dirpath]
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+# Method to build a SizeReport for a folder. progress is called with the number
+# of files scanned after each folder and may raise to abort.
+def scan_sizes(root, top_k=DEFAULT_TOP_K, progress=None, **scan_options):
+    root = os.path.normpath(root)
+    report = SizeReport(root, top_k)
+    for dirpath, _, files in walk(root, **scan_options):
+        report.add_directory(dirpath, files)
+        if progress:
+            progress(report.file_count)
+    return report
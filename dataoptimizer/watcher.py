@@ -0,0 +1,392 @@
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import os
+import select
+import sqlite3
+import stat
+import struct
+import threading
+import time
+from collections import defaultdict
+from .duplicates import DuplicateFinder
+from .hashing import HashEngine
+from .index import path_range
+from .scanner import FileRecord, matches_any, walk
+
+# inotify event flags, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events a directory is watched for
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+# Header of an event read from an inotify descriptor: wd, mask, cookie, name length
+EVENT_HEADER = struct.Struct("iIII")
+
+# Seconds without new events after which changed files are processed
+DEFAULT_DEBOUNCE = 2.0
+
+# Changes are processed after this many seconds at the latest, even while events keep coming
+MAX_DEBOUNCE_DELAY = 30.0
+
+# Seconds between incremental rescans when inotify is not available or out of watches
+DEFAULT_RESCAN_INTERVAL = 300.0
+
+# Seconds to wait before trying again after the index could not be written
+INDEX_RETRY_DELAY = 5.0
+
+# Class for an inotify instance, used through ctypes so no extra package is
+# needed. Raises OSError where inotify is not available.
+class Inotify:
+    def __init__(self):
+        library = ctypes.util.find_library("c")
+        try:
+            self.libc = ctypes.CDLL(library, use_errno=True)
+            self.libc.inotify_init1
+        except (OSError, AttributeError, TypeError):
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+    # Watch a directory and return its watch descriptor. Raises OSError with
+    # ENOSPC once the user's watch limit (fs.inotify.max_user_watches) is reached.
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def remove_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    # Wait up to timeout seconds for events and return them as (wd, mask, cookie, name) tuples
+    def read_events(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+# Class to keep the file index of a folder up to date while files change. After
+# one full scan, changes reported by inotify are collected and processed in
+# debounced batches: changed files are recorded in the index, and files whose
+# size now collides with another file are hashed. Where inotify is missing or
+# runs out of watches, the folder is rescanned every rescan_interval seconds
+# instead. duplicates() and largest_files() answer from memory without a walk,
+# and the index can be queried by other processes, see FileIndex.duplicate_groups.
+class IndexWatcher:
+    def __init__(self, root, index, engine=None, debounce=DEFAULT_DEBOUNCE, rescan_interval=DEFAULT_RESCAN_INTERVAL,
+                 include=None, exclude=None, onevent=None, onerror=None):
+        self.root = os.path.abspath(root)
+        self.index = index
+        self.engine = engine or HashEngine.for_path(root)
+        self.onerror = onerror
+        # A file that cannot be hashed is reported and left out of its size group
+        self.finder = DuplicateFinder(self.engine, index, onerror=self.report_error)
+        self.debounce = debounce
+        self.rescan_interval = rescan_interval
+        self.include = include
+        self.exclude = exclude
+        # Called with an event dict when the watcher starts, falls back or processes a batch
+        self.onevent = onevent
+        # Guards records, files_by_size and full_hashes, which other threads may query
+        self.lock = threading.Lock()
+        self.records = {}
+        self.files_by_size = defaultdict(set)
+        self.full_hashes = {}
+        self.inotify = None
+        self.watches = {}
+        # Changes seen since the last batch
+        self.dirty_files = set()
+        self.dirty_dirs = set()
+        self.removed_dirs = set()
+        self.needs_rescan = False
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def report(self, event):
+        if self.onevent:
+            self.onevent(event)
+
+    def report_error(self, e):
+        if self.onerror:
+            self.onerror(e)
+
+    # Watch the folder until stop() is called
+    def run(self):
+        while not self.index_call(self.index.begin_scan, self.root, self.engine.algorithm):
+            if self.stop_event.wait(INDEX_RETRY_DELAY):
+                return
+        try:
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                self.report({"event": "fallback", "reason": str(e)})
+            self.index_call(self.rescan)
+            self.report({"event": "watching", "mode": "inotify" if self.inotify else "rescan", "files": len(self.records), "watches": len(self.watches)})
+            if self.inotify:
+                self.watch_events()
+            while not self.stop_event.wait(INDEX_RETRY_DELAY if self.needs_rescan else self.rescan_interval):
+                self.index_call(self.rescan)
+        finally:
+            if self.inotify:
+                self.inotify.close()
+                self.inotify = None
+            self.index_call(self.index.finish_scan)
+
+    # Call a function that writes to the index and return whether it succeeded.
+    # If the index stays locked (e.g. by another process writing to it for
+    # longer than BUSY_TIMEOUT) or cannot be written otherwise, the error is
+    # reported and the batch is rolled back. What is known in memory is dropped
+    # as well, so the next rescan records every file again, and the watcher
+    # keeps running.
+    def index_call(self, function, *args):
+        try:
+            function(*args)
+            return True
+        except sqlite3.OperationalError as e:
+            self.report_error(e)
+            try:
+                self.index.rollback()
+            except sqlite3.OperationalError:
+                pass
+            with self.lock:
+                self.records.clear()
+                self.files_by_size.clear()
+                self.full_hashes.clear()
+            self.needs_rescan = True
+            return False
+
+    # Collect inotify events and process them once they settle
+    def watch_events(self):
+        first_event = last_event = None
+        last_failure = None
+        while self.inotify and not self.stop_event.is_set():
+            events = self.inotify.read_events(self.debounce / 4)
+            now = time.monotonic()
+            if events:
+                for event in events:
+                    self.handle_event(*event)
+                last_event = now
+                first_event = first_event or now
+            settled = first_event and (now - last_event >= self.debounce or now - first_event >= MAX_DEBOUNCE_DELAY)
+            # A batch that failed to reach the index is retried as a rescan
+            retry = last_failure and now - last_failure >= INDEX_RETRY_DELAY
+            if settled or retry:
+                if self.needs_rescan:
+                    succeeded = self.index_call(self.rescan)
+                else:
+                    succeeded = self.index_call(self.process_changes)
+                last_failure = None if succeeded else now
+                first_event = last_event = None
+
+    def handle_event(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, only a rescan can tell what changed
+            self.needs_rescan = True
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if directory == self.root:
+                self.needs_rescan = True
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.dirty_dirs.add(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.removed_dirs.add(path)
+        else:
+            self.dirty_files.add(path)
+
+    # Watch a directory, falling back to rescans once the watches run out
+    def add_watch(self, directory):
+        if not self.inotify:
+            return
+        try:
+            self.watches[self.inotify.add_watch(directory)] = directory
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                self.report_error(e)
+                return
+            self.inotify.close()
+            self.inotify = None
+            self.watches.clear()
+            self.report({"event": "fallback", "reason": "out of inotify watches, raise fs.inotify.max_user_watches to avoid rescans"})
+
+    # Check a file or folder against the exclude patterns, relative to the root
+    def excluded(self, path):
+        return bool(self.exclude) and matches_any(os.path.basename(path), os.path.relpath(path, self.root), self.exclude)
+
+    def accepts(self, path):
+        if self.excluded(path):
+            return False
+        if self.include and not matches_any(os.path.basename(path), os.path.relpath(path, self.root), self.include):
+            return False
+        return not self.index.is_index_file(path)
+
+    # Walk a folder, watching every directory in it, and return its FileRecords.
+    # Excluded folders are pruned by their path below the root, not below the
+    # walked folder, so a folder created at runtime is treated like in a rescan.
+    def scan_folder(self, folder):
+        if folder != self.root and self.excluded(folder):
+            return []
+        records = []
+        for dirpath, dirnames, files in walk(folder, onerror=self.report_error):
+            dirnames[:] = [name for name in dirnames if not self.excluded(os.path.join(dirpath, name))]
+            self.add_watch(dirpath)
+            records.extend(record for record in files if self.accepts(record.path))
+        return records
+
+    # Compare the whole folder with what is known and process the differences
+    def rescan(self):
+        self.needs_rescan = False
+        self.dirty_files.clear()
+        self.dirty_dirs.clear()
+        self.removed_dirs.clear()
+        seen = set()
+        changed = []
+        for record in self.scan_folder(self.root):
+            seen.add(record.path)
+            if self.records.get(record.path) != record:
+                changed.append(record)
+        removed = [path for path in self.records if path not in seen]
+        self.apply_changes(changed, removed)
+
+    # Turn the collected events into changed and removed files and process them
+    def process_changes(self):
+        # A file in a new folder can be reported on its own as well, so changes are keyed by path
+        changed = {}
+        # A file in a removed tree is reported by its folder and its own event, so removals are a set
+        removed = set()
+        for directory in self.dirty_dirs:
+            changed.update((record.path, record) for record in self.scan_folder(directory))
+        for directory in self.removed_dirs:
+            low, high = path_range(directory)
+            removed.update(path for path in self.records if low <= path < high and not os.path.lexists(path))
+            for wd, watched in list(self.watches.items()):
+                if (low <= watched < high or watched == directory) and not os.path.isdir(watched):
+                    if self.inotify:
+                        self.inotify.remove_watch(wd)
+                    del self.watches[wd]
+        for path in self.dirty_files:
+            try:
+                file_stat = os.lstat(path)
+            except FileNotFoundError:
+                if path in self.records:
+                    removed.add(path)
+                continue
+            except OSError as e:
+                self.report_error(e)
+                continue
+            if stat.S_ISREG(file_stat.st_mode) and self.accepts(path):
+                record = FileRecord(path, os.path.basename(path), file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_dev, file_stat.st_ino)
+                if self.records.get(path) != record:
+                    changed[path] = record
+        self.dirty_files.clear()
+        self.dirty_dirs.clear()
+        self.removed_dirs.clear()
+        self.apply_changes(list(changed.values()), removed)
+
+    # Update the known files and the index, then hash the files whose size
+    # collides with a changed one
+    def apply_changes(self, changed, removed):
+        if not changed and not removed:
+            return
+        affected_sizes = set()
+        with self.lock:
+            for path in removed:
+                record = self.records.pop(path, None)
+                if record:
+                    self.files_by_size[record.size].discard(path)
+                    affected_sizes.add(record.size)
+                self.full_hashes.pop(path, None)
+            for record in changed:
+                old_record = self.records.get(record.path)
+                if old_record:
+                    self.files_by_size[old_record.size].discard(record.path)
+                    affected_sizes.add(old_record.size)
+                self.records[record.path] = record
+                self.files_by_size[record.size].add(record.path)
+                self.full_hashes.pop(record.path, None)
+                affected_sizes.add(record.size)
+
+        cached_hashes = {record.path: self.index.record(record) for record in changed}
+        self.index.forget(removed)
+        candidates = []
+        for size in affected_sizes:
+            paths = self.files_by_size.get(size)
+            if paths and len(paths) > 1:
+                for path in paths:
+                    candidates.append((path, size))
+                    if path not in cached_hashes:
+                        # Unchanged files keep the hashes stored by earlier batches
+                        cached_hashes[path] = self.index.record(self.records[path])
+        files_by_hash = self.finder.hash_files_staged(candidates, self.engine, cached_hashes)
+        self.index.commit()
+
+        with self.lock:
+            for path, _ in candidates:
+                self.full_hashes.pop(path, None)
+            for full_hash, paths in files_by_hash.items():
+                for path in paths:
+                    if path in self.records:
+                        self.full_hashes[path] = full_hash
+            for size in affected_sizes:
+                if not self.files_by_size.get(size, True):
+                    del self.files_by_size[size]
+        self.report({"event": "updated", "changed": len(changed), "removed": len(removed), "hashed": len(candidates), "files": len(self.records)})
+
+    # Groups of paths with the same content, from memory
+    def duplicates(self):
+        with self.lock:
+            groups = defaultdict(list)
+            for path, full_hash in self.full_hashes.items():
+                groups[full_hash].append(path)
+        return {full_hash: sorted(paths) for full_hash, paths in groups.items() if len(paths) > 1}
+
+    # The largest files as a list of (path, size), from memory
+    def largest_files(self, limit):
+        with self.lock:
+            return [(record.path, record.size) for record in heapq.nlargest(limit, self.records.values(), key=lambda record: record.size)]
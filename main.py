@@ -1,106 +1,231 @@
+import json
 import os
-import hashlib
-from collections import defaultdict
+import tempfile
+import time
 import tkinter as tk
-from tkinter import scrolledtext, ttk
+from tkinter import messagebox, scrolledtext, ttk
 import customtkinter as ctk
 from CTkListbox import *
-from tkinter.filedialog import askdirectory
-import zipfile
-import json
+from tkinter.filedialog import askdirectory, asksaveasfilename
+from dataoptimizer.compression import compress_files
+from dataoptimizer.duplicates import DuplicateFinder
+from dataoptimizer.folders import create_folders
+from dataoptimizer.hashing import DEFAULT_ALGORITHM, HASH_ALGORITHMS, HashEngine
+from dataoptimizer.index import FileIndex
+from dataoptimizer.linking import describe_link_event, link_duplicates
+from dataoptimizer.merging import describe_merge_event, describe_merge_plan, merge_folders, plan_merge
+from dataoptimizer.similarity import find_similar_folders
+from dataoptimizer.sizes import DEFAULT_TOP_K, scan_sizes
+from dataoptimizer.jobs import Job, MAX_OUTPUT_PER_UPDATE, UPDATE_INTERVAL_MS
 
 # Set default theme
 ctk.set_appearance_mode("System")
 
-# Hashing function
-def hash_file(filepath):
-    hash_obj = hashlib.md5()
-    with open(filepath, 'rb') as file:
-        while chunk := file.read(8192):
-            hash_obj.update(chunk)
-    return hash_obj.hexdigest()
-
-# Method to create a tree structure of folders
-def map_folder_structure(path):
-    folder_tree = defaultdict(dict)
-    for root, dirs, files in os.walk(path):
-        # Remove the base directory from the path
-        relative_root = os.path.relpath(root, path)
-        folder_tree[relative_root] = {
-            "dirs": sorted(dirs),
-            "files": sorted(files)
-        }
-    return folder_tree
-
-# Method to calculate the percentage of matching subfolders
-def calculate_similarity_percentage(folder1, folder2):
-    set1 = set(folder1.keys())
-    set2 = set(folder2.keys())
-    common_folders = set1 & set2
-    if not set1 and not set2:
-        return 100
-    return len(common_folders) / min(len(set1), len(set2)) * 100
-
-# Method to check if the number of subfolders is within ±25%
-def is_folder_count_similar(folder1, folder2):
-    count1 = len(folder1)
-    count2 = len(folder2)
-    lower_bound = 0.75 * count1
-    upper_bound = 1.25 * count1
-    return lower_bound <= count2 <= upper_bound
-
-# Method to compare the tree structure of two folders
-def compare_folder_structures(tree1, tree2):
-    similar_folders = []
-    for folder in tree1:
-        if folder in tree2 and tree1[folder] == tree2[folder]:
-            similar_folders.append(folder)
-    return similar_folders
-
-# Class to find duplicates
-class DuplicateFinder:
-    def __init__(self):
-        self.files_by_hash = {}
-        self.files_by_size = {}
-        self.files_by_name = {}
-        self.files_by_date = {}
-
-    def find_duplicates(self, folder, methods=["hash"]):
-        index_file = os.path.join(folder, "index.json")
-        if os.path.exists(index_file):
-            with open(index_file, "r") as f:
-                self.files_by_hash, self.files_by_size, self.files_by_name, self.files_by_date = json.load(f)
+# Method to format a size in bytes in the given unit
+def format_size(size, size_unit):
+    if size_unit == "KB":
+        return f"{size / 1024:.2f} KB"
+    elif size_unit == "MB":
+        return f"{size / (1024 * 1024):.2f} MB"
+    elif size_unit == "GB":
+        return f"{size / (1024 * 1024 * 1024):.2f} GB"
+    else:
+        return f"{size} Bytes"
+
+# Job function to create a list of folders below a base path
+def create_folders_job(job, base_path, folder_list):
+    total_folders = len(folder_list)
+    for i, folder_path in enumerate(create_folders(base_path, folder_list)):
+        progress = (i + 1) / total_folders
+        job.set_progress(progress, f"{progress * 100:.0f}%")
+        job.output(f"Created: {folder_path}\n")
+        job.check_cancelled()
+
+# Job function to find duplicates and stream the groups as output
+def find_duplicates_job(job, target_path, methods, engine, size_unit):
+    def report_progress(stage, done, total):
+        job.check_cancelled()
+        if total:
+            job.set_progress(done / total, f"{stage} {done}/{total}")
         else:
-            for root, _, files in os.walk(folder):
-                for file in files:
-                    path = os.path.join(root, file)
-                    if "hash" in methods:
-                        file_key = hash_file(path)
-                        self.files_by_hash.setdefault(file_key, []).append(path)
-                    if "size" in methods:
-                        file_key = os.path.getsize(path)
-                        self.files_by_size.setdefault(file_key, []).append(path)
-                    if "name" in methods:
-                        file_key = file
-                        self.files_by_name.setdefault(file_key, []).append(path)
-                    if "date" in methods:
-                        file_key = os.path.getmtime(path)
-                        self.files_by_date.setdefault(file_key, []).append(path)
-
-            with open(index_file, "w") as f:
-                json.dump([self.files_by_hash, self.files_by_size, self.files_by_name, self.files_by_date], f)
-        
-        duplicates = {}
-        if "hash" in methods:
-            duplicates.update({hash: paths for hash, paths in self.files_by_hash.items() if len(paths) > 1})
-        if "size" in methods:
-            duplicates.update({size: paths for size, paths in self.files_by_size.items() if len(paths) > 1})
-        if "name" in methods:
-            duplicates.update({name: paths for name, paths in self.files_by_name.items() if len(paths) > 1})
-        if "date" in methods:
-            duplicates.update({date: paths for date, paths in self.files_by_date.items() if len(paths) > 1})
-        
-        return duplicates
+            job.set_progress(0, f"{stage} {done} files")
+
+    def report_error(e):
+        print(f"Error hashing: {e}")
+
+    index = FileIndex()
+    try:
+        duplicate_finder = DuplicateFinder(engine, index, report_progress, job.metrics, report_error)
+        duplicate_finder.scan(target_path, methods)
+    finally:
+        index.close()
+
+    for method, file_key, paths in duplicate_finder.iter_duplicates(methods):
+        if method == "tree":
+            total_size, file_count = duplicate_finder.tree_sizes[file_key]
+            header = f"Identical folders ({format_size(total_size, size_unit)}, {file_count} files each):\n"
+        else:
+            header = f"Duplicates for {file_key}:\n"
+        job.output(header + "".join(f"  {path}\n" for path in paths))
+    job.set_progress(1, "100%")
+    return duplicate_finder
+
+# Job function to replace duplicate files with links to one kept copy per group
+def link_duplicates_job(job, duplicate_finder, policy, preferred_root, mode, size_unit):
+    reclaimed = 0
+    linked = 0
+    # Groups are built one at a time on the job's thread, not on the Tk thread
+    groups = (paths for _, _, paths in duplicate_finder.iter_duplicates(["hash"]))
+    for event in link_duplicates(groups, policy, preferred_root, mode):
+        job.output(describe_link_event(event))
+        if event["action"] == "linked":
+            linked += 1
+            reclaimed += event["reclaimed"]
+        job.check_cancelled()
+    job.output(f"Replaced {linked} files, reclaimed {format_size(reclaimed, size_unit)}\n")
+    job.set_progress(1, "100%")
+
+# Job function to build a size report of all files below a path
+def scan_files_by_size_job(job, target_path, top_k):
+    def report_error(e):
+        print(f"Error scanning: {e}")
+
+    def report_progress(file_count):
+        job.check_cancelled()
+        job.set_progress(0, f"{file_count} files")
+
+    report = scan_sizes(target_path, top_k, report_progress, onerror=report_error, metrics=job.metrics)
+    job.set_progress(1, f"{report.file_count} files")
+    return report
+
+# Job function to compress files into a ZIP archive
+def compress_files_job(job, files, zip_filename, base_path, codec):
+    def report_error(e):
+        print(f"Error compressing: {e}")
+
+    for i, entry in enumerate(compress_files(files, zip_filename, base_path, codec, onerror=report_error, metrics=job.metrics)):
+        job.set_progress((i + 1) / len(files), f"{i + 1}/{len(files)}")
+        job.check_cancelled()
+
+# Job function to find groups of subfolders with a similar structure
+def scan_similar_folders_job(job, target_path, threshold):
+    def report_progress(done, total):
+        job.check_cancelled()
+        job.set_progress(done / total if total else 0, f"{done}/{total}")
+
+    return list(find_similar_folders(target_path, threshold, report_progress, metrics=job.metrics))
+
+# Job function to plan merging groups of folders into the first folder of each
+# group and show what a merge would do, without changing anything
+def plan_merge_job(job, folder_groups, remove_identical):
+    for i, folders in enumerate(folder_groups):
+        primary_folder = folders[0]
+        for folder in folders[1:]:
+            try:
+                job.output(describe_merge_plan(plan_merge(primary_folder, folder, metrics=job.metrics, remove_identical=remove_identical)))
+            except ValueError as e:
+                job.output(f"Skipped: {e}\n")
+            job.check_cancelled()
+        job.set_progress((i + 1) / len(folder_groups), f"{i + 1}/{len(folder_groups)}")
+
+# Job function to merge groups of folders into the first folder of each group
+def merge_folders_job(job, folder_groups, remove_identical):
+    for i, folders in enumerate(folder_groups):
+        primary_folder = folders[0]
+        for folder in folders[1:]:
+            try:
+                for event in merge_folders(primary_folder, folder, metrics=job.metrics, remove_identical=remove_identical):
+                    job.output(describe_merge_event(event))
+                    job.check_cancelled()
+            except ValueError as e:
+                job.output(f"Skipped: {e}\n")
+        job.set_progress((i + 1) / len(folder_groups), f"{i + 1}/{len(folder_groups)}")
+
+# Class for a Treeview that only creates the rows visible on screen. Rows are kept
+# as plain data and turned into cell values by format_row while scrolling, and
+# the selection is tracked by row index so it survives scrolling.
+class VirtualTreeview(ttk.Frame):
+    def __init__(self, master, columns):
+        super().__init__(master)
+        self.tree = ttk.Treeview(self, columns=columns, show="headings")
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill='y')
+        self.tree.pack(side=tk.LEFT, fill='both', expand=True)
+
+        self.rows = []
+        self.format_row = lambda row: row
+        self.first_row = 0
+        self.selected = set()
+
+        self.tree.bind("<Configure>", lambda _: self.refresh())
+        self.tree.bind("<<TreeviewSelect>>", self.on_select)
+        self.tree.bind("<ButtonPress-1>", self.on_click)
+        self.tree.bind("<MouseWheel>", self.on_mousewheel)
+        self.tree.bind("<Button-4>", lambda _: self.scroll(-3))
+        self.tree.bind("<Button-5>", lambda _: self.scroll(3))
+
+    def set_rows(self, rows, format_row, headings):
+        for column, text in headings.items():
+            self.tree.heading(column, text=text)
+        self.rows = rows
+        self.format_row = format_row
+        self.first_row = 0
+        self.selected = set()
+        self.refresh()
+
+    def visible_row_count(self):
+        row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        # Leave room for the heading row
+        return max(1, self.tree.winfo_height() // row_height - 1)
+
+    def refresh(self):
+        count = self.visible_row_count()
+        self.first_row = max(0, min(self.first_row, len(self.rows) - count))
+        last_row = min(self.first_row + count, len(self.rows))
+
+        self.tree.delete(*self.tree.get_children())
+        for i in range(self.first_row, last_row):
+            self.tree.insert("", "end", iid=str(i), values=self.format_row(self.rows[i]))
+        self.tree.selection_set([str(i) for i in range(self.first_row, last_row) if i in self.selected])
+
+        if self.rows:
+            self.scrollbar.set(self.first_row / len(self.rows), last_row / len(self.rows))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll(self, rows):
+        self.first_row += rows
+        self.refresh()
+
+    def on_mousewheel(self, event):
+        # Windows reports multiples of 120 per notch, macOS small deltas
+        steps = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        self.scroll(-3 * steps)
+
+    def on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            self.first_row = int(float(amount) * len(self.rows))
+            self.refresh()
+        elif unit == "pages":
+            self.scroll(int(amount) * self.visible_row_count())
+        else:
+            self.scroll(int(amount))
+
+    def on_click(self, event):
+        # A click without Shift or Control starts a new selection
+        if not event.state & 0x0005:
+            self.selected.clear()
+
+    def on_select(self, _):
+        selection = set(self.tree.selection())
+        for i in range(self.first_row, self.first_row + len(self.tree.get_children())):
+            if str(i) in selection:
+                self.selected.add(i)
+            else:
+                self.selected.discard(i)
+
+    def selected_rows(self):
+        return [self.rows[i] for i in sorted(self.selected)]
 
 class DataOptimizer(ctk.CTk):
     def __init__(self):
@@ -123,6 +248,13 @@ class DataOptimizer(ctk.CTk):
         self.setup_file_size_tab()
         self.setup_merge_folders_tab()
 
+        # Background job per tab, see start_job
+        self.jobs = {}
+        # Whether new jobs are profiled, set in the performance window
+        self.profile_var = tk.BooleanVar(value=False)
+        self.trace_memory_var = tk.BooleanVar(value=False)
+        self.performance_window = None
+
         self.is_night_mode = False
         self.setup_theme_switch_button()
 
@@ -145,9 +277,22 @@ class DataOptimizer(ctk.CTk):
         scan_button = ctk.CTkButton(button_frame, text="Find Similar Folders", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.scan_similar_folders)
         scan_button.pack(side=tk.LEFT, padx=5)
 
+        self.similarity_threshold_entry = ctk.CTkEntry(button_frame, width=120, placeholder_text="Similarity % (60)")
+        self.similarity_threshold_entry.pack(side=tk.LEFT, padx=5)
+
+        dry_run_button = ctk.CTkButton(button_frame, text="Dry Run", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=lambda: self.merge_selected_folders(dry_run=True))
+        dry_run_button.pack(side=tk.LEFT, padx=5)
+
+        self.remove_identical_var = tk.BooleanVar(value=False)
+        remove_identical_check = ctk.CTkCheckBox(button_frame, text="Remove identical files", variable=self.remove_identical_var)
+        remove_identical_check.pack(side=tk.LEFT, padx=5)
+
         merge_button = ctk.CTkButton(button_frame, text="Merge Selected Folders", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.merge_selected_folders)
         merge_button.pack(side=tk.LEFT, padx=5)
 
+        cancel_button = ctk.CTkButton(button_frame, text="Cancel", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=lambda: self.cancel_job("merge"))
+        cancel_button.pack(side=tk.LEFT, padx=5)
+
         self.similar_folders_listbox = CTkListbox(self.merge_folders_tab, multiple_selection=True)
         self.similar_folders_listbox.pack(pady=10, padx=10, fill="both", expand=True)
 
@@ -162,75 +307,163 @@ class DataOptimizer(ctk.CTk):
             ctk.CTkMessageBox.show_warning(title="Warning", message="Please specify a target path.")
             return
 
-        all_folders = [os.path.join(target_path, d) for d in os.listdir(target_path) if os.path.isdir(os.path.join(target_path, d))]
-
-        folder_structures = {folder: map_folder_structure(folder) for folder in all_folders}
-        similar_groups = []
+        threshold = self.similarity_threshold_entry.get().strip()
+        try:
+            threshold = float(threshold) if threshold else 60
+        except ValueError:
+            ctk.CTkMessageBox.show_warning(title="Warning", message="The similarity threshold must be a number.")
+            return
 
-        for i, folder1 in enumerate(all_folders):
-            common_group = [folder1]
-            for folder2 in all_folders[i + 1:]:
-                if is_folder_count_similar(folder_structures[folder1], folder_structures[folder2]):
-                    similarity = calculate_similarity_percentage(folder_structures[folder1], folder_structures[folder2])
-                    if similarity >= 60:
-                        common_group.append(folder2)
-            if len(common_group) > 1:
-                similar_groups.append(common_group)
+        self.start_job("merge", scan_similar_folders_job, target_path, threshold, on_done=self.show_similar_folders)
 
+    def show_similar_folders(self, similar_groups):
         self.similar_folders_listbox.delete(0, tk.END)
         for group in similar_groups:
             display_text = " <-> ".join(group)
             self.similar_folders_listbox.insert(tk.END, display_text)
 
-    def merge_folders(self, folder1, folder2):
-        for root, dirs, files in os.walk(folder2):
-            relative_path = os.path.relpath(root, folder2)
-            dest_path = os.path.join(folder1, relative_path)
-            try:
-                os.makedirs(dest_path, exist_ok=True)
-            except OSError as e:
-                self.output_terminal.insert(tk.END, f"Error creating directory {dest_path}: {e}\n")
-                continue
-
-            for file in files:
-                src_file = os.path.join(root, file)
-                dest_file = os.path.join(dest_path, file)
-                try:
-                    if not os.path.exists(dest_file):
-                        os.rename(src_file, dest_file)
-                        self.output_terminal.insert(tk.END, f"Moved: {src_file} -> {dest_file}\n")
-                    else:
-                        self.output_terminal.insert(tk.END, f"Skipped (file already exists): {src_file}\n")
-                except OSError as e:
-                    self.output_terminal.insert(tk.END, f"Error moving file {src_file}: {e}\n")
-            self.update_idletasks()
-
-        try:
-            os.rmdir(folder2)
-            self.output_terminal.insert(tk.END, f"Deleted: {folder2}\n")
-        except OSError as e:
-            self.output_terminal.insert(tk.END, f"Could not delete folder (not empty or no permission): {folder2}\nError: {e}\n")
-        self.update_idletasks()
-
-    def merge_selected_folders(self):
+    def merge_selected_folders(self, dry_run=False):
         selected_items = self.similar_folders_listbox.curselection()
         if not selected_items:
             ctk.CTkMessageBox.show_warning(title="Warning", message="Please select folders to merge.")
             return
 
-        for index in selected_items:
-            display_text = self.similar_folders_listbox.get(index)
-            folders = display_text.split(' <-> ')
-            primary_folder = folders[0]
-            for folder in folders[1:]:
-                self.merge_folders(primary_folder, folder)
+        folder_groups = [self.similar_folders_listbox.get(index).split(' <-> ') for index in selected_items]
+        if dry_run:
+            self.start_job("merge", plan_merge_job, folder_groups, self.remove_identical_var.get(), terminal=self.output_terminal)
+            return
+        self.start_job("merge", merge_folders_job, folder_groups, self.remove_identical_var.get(), terminal=self.output_terminal,
+                       on_done=lambda _: ctk.CTkMessageBox.show_info(title="Info", message="Folders successfully merged."))
+
+    # Run a job function on a background thread, one job per tab name. Output and
+    # progress are applied to the given widgets every UPDATE_INTERVAL_MS, and
+    # on_done is called with the job's result on the Tk thread once it finishes.
+    def start_job(self, name, target, *args, progress_bar=None, progress_label=None, terminal=None, on_done=None):
+        running_job = self.jobs.get(name)
+        if running_job and not running_job.finished:
+            ctk.CTkMessageBox.show_warning(title="Warning", message="Please wait for the running operation to finish or cancel it.")
+            return
+
+        profile_path = None
+        if self.profile_var.get():
+            profile_path = os.path.join(tempfile.gettempdir(), f"dataoptimizer-{name}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        job = Job(target, *args, profile_path=profile_path, trace_memory=self.trace_memory_var.get()).start()
+        self.jobs[name] = job
+        self.after(UPDATE_INTERVAL_MS, self.poll_job, job, progress_bar, progress_label, terminal, on_done)
+
+    def poll_job(self, job, progress_bar, progress_label, terminal, on_done):
+        with job.metrics.phase("gui"):
+            self.update_job_widgets(job, progress_bar, progress_label, terminal, on_done)
+
+    def update_job_widgets(self, job, progress_bar, progress_label, terminal, on_done):
+        finished = job.finished
+        output = job.drain_output(None if finished else MAX_OUTPUT_PER_UPDATE)
+        if output:
+            if terminal:
+                terminal.insert(tk.END, "".join(output))
+                terminal.see(tk.END)
+            else:
+                print("".join(output), end="")
+
+        fraction, text = job.progress
+        if progress_bar:
+            progress_bar.set(fraction)
+        if progress_label:
+            progress_label.configure(text=text)
+
+        if not finished:
+            self.after(UPDATE_INTERVAL_MS, self.poll_job, job, progress_bar, progress_label, terminal, on_done)
+            return
+
+        if job.profile_path:
+            print(f"Profile written to {job.profile_path}")
+        if job.error:
+            message = f"Error: {job.error}\n"
+        elif job.cancelled:
+            message = "Cancelled.\n"
+        else:
+            if on_done:
+                on_done(job.result)
+            return
+        if terminal:
+            terminal.insert(tk.END, message)
+            terminal.see(tk.END)
+        else:
+            print(message, end="")
 
-        ctk.CTkMessageBox.show_info(title="Info", message="Folders successfully merged.")
+    def cancel_job(self, name):
+        job = self.jobs.get(name)
+        if job:
+            job.cancel()
 
     def setup_theme_switch_button(self):
         theme_switch_btn = ctk.CTkButton(self, text="Night/Day Mode", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.toggle_theme)
         theme_switch_btn.pack(pady=10)
 
+        performance_btn = ctk.CTkButton(self, text="Performance", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.show_performance_window)
+        performance_btn.pack(pady=(0, 10))
+
+    # Open a window with the live metrics of every job and options to export and profile them
+    def show_performance_window(self):
+        if self.performance_window and self.performance_window.winfo_exists():
+            self.performance_window.lift()
+            return
+
+        window = ctk.CTkToplevel(self)
+        window.title("Performance")
+        window.geometry("800x500")
+        self.performance_window = window
+
+        option_frame = ctk.CTkFrame(window)
+        option_frame.pack(pady=10, padx=10, fill='x')
+
+        profile_check = ctk.CTkCheckBox(option_frame, text="Profile new runs", variable=self.profile_var)
+        profile_check.pack(side=tk.LEFT, padx=5)
+
+        trace_memory_check = ctk.CTkCheckBox(option_frame, text="Trace memory", variable=self.trace_memory_var)
+        trace_memory_check.pack(side=tk.LEFT, padx=5)
+
+        json_button = ctk.CTkButton(option_frame, text="Export JSON", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=lambda: self.export_metrics("json"))
+        json_button.pack(side=tk.LEFT, padx=5)
+
+        prometheus_button = ctk.CTkButton(option_frame, text="Export Prometheus", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=lambda: self.export_metrics("prometheus"))
+        prometheus_button.pack(side=tk.LEFT, padx=5)
+
+        self.performance_text = scrolledtext.ScrolledText(window, height=20, background='black', foreground='green', font=('Arial', 10))
+        self.performance_text.pack(pady=5, padx=10, fill='both', expand=True)
+        self.refresh_performance_window()
+
+    def refresh_performance_window(self):
+        if not self.performance_window or not self.performance_window.winfo_exists():
+            return
+        lines = []
+        for name, job in self.jobs.items():
+            state = "running" if not job.finished else "finished"
+            lines.append(f"== {name} ({state}) ==\n")
+            lines.extend(job.metrics.describe())
+            lines.append("\n")
+        self.performance_text.delete("1.0", tk.END)
+        self.performance_text.insert(tk.END, "".join(lines) or "No operations yet.\n")
+        self.after(5 * UPDATE_INTERVAL_MS, self.refresh_performance_window)
+
+    # Write the metrics of every job to a file, as JSON or Prometheus text
+    def export_metrics(self, export_format):
+        if not self.jobs:
+            ctk.CTkMessageBox.show_warning(title="Warning", message="There are no metrics to export yet.")
+            return
+        if export_format == "json":
+            filename = asksaveasfilename(defaultextension=".json", initialfile="metrics.json", filetypes=[("JSON", "*.json")])
+        else:
+            filename = asksaveasfilename(defaultextension=".prom", initialfile="metrics.prom", filetypes=[("Prometheus text", "*.prom")])
+        if not filename:
+            return
+        with open(filename, "w") as f:
+            if export_format == "json":
+                json.dump({name: job.metrics.snapshot() for name, job in self.jobs.items()}, f, indent=2)
+            else:
+                for name, job in self.jobs.items():
+                    f.write(job.metrics.to_prometheus(f"dataoptimizer_{name}"))
+
     def toggle_theme(self):
         self.is_night_mode = not self.is_night_mode
         if self.is_night_mode:
@@ -279,6 +512,9 @@ class DataOptimizer(ctk.CTk):
         create_button = ctk.CTkButton(button_frame, text="Create Folders", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.create_folders)
         create_button.pack(side=tk.LEFT, padx=5)
 
+        cancel_button = ctk.CTkButton(button_frame, text="Cancel", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=lambda: self.cancel_job("create"))
+        cancel_button.pack(side=tk.LEFT, padx=5)
+
         self.progress_bar = ctk.CTkProgressBar(button_frame, mode='determinate')
         self.progress_bar.pack(side=tk.LEFT, padx=5, fill='x', expand=True)
         self.progress_bar.set(0)
@@ -311,11 +547,42 @@ class DataOptimizer(ctk.CTk):
         scan_button = ctk.CTkButton(button_frame, text="Find Duplicates", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.scan_duplicates)
         scan_button.pack(side=tk.LEFT, padx=5)
 
+        cancel_button = ctk.CTkButton(button_frame, text="Cancel", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=lambda: self.cancel_job("duplicates"))
+        cancel_button.pack(side=tk.LEFT, padx=5)
+
         self.duplicate_method_listbox = tk.Listbox(button_frame, selectmode=tk.MULTIPLE)
-        for method in ["hash", "size", "name", "date"]:
+        for method in ["hash", "size", "name", "date", "tree"]:
             self.duplicate_method_listbox.insert(tk.END, method)
         self.duplicate_method_listbox.pack(side=tk.LEFT, padx=5)
 
+        self.storage_var = tk.StringVar(value="Auto")
+        storage_options = ttk.Combobox(button_frame, textvariable=self.storage_var, values=["Auto", "SSD", "HDD"], width=6)
+        storage_options.pack(side=tk.LEFT, padx=5)
+
+        self.hash_algorithm_var = tk.StringVar(value=DEFAULT_ALGORITHM)
+        algorithm_options = ttk.Combobox(button_frame, textvariable=self.hash_algorithm_var, values=list(HASH_ALGORITHMS), width=8, state="readonly")
+        algorithm_options.pack(side=tk.LEFT, padx=5)
+
+        self.hash_workers_entry = ctk.CTkEntry(button_frame, width=80, placeholder_text="Workers")
+        self.hash_workers_entry.pack(side=tk.LEFT, padx=5)
+
+        link_frame = ctk.CTkFrame(self.remove_duplicates_tab)
+        link_frame.pack(pady=10, padx=10, fill='x')
+
+        link_button = ctk.CTkButton(link_frame, text="Replace Duplicates with Links", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.link_duplicates)
+        link_button.pack(side=tk.LEFT, padx=5)
+
+        self.keep_policy_var = tk.StringVar(value="Oldest")
+        keep_options = ttk.Combobox(link_frame, textvariable=self.keep_policy_var, values=["Oldest", "Shortest Path"], width=12, state="readonly")
+        keep_options.pack(side=tk.LEFT, padx=5)
+
+        self.link_mode_var = tk.StringVar(value="Auto")
+        link_mode_options = ttk.Combobox(link_frame, textvariable=self.link_mode_var, values=["Auto", "Reflink", "Hardlink"], width=8, state="readonly")
+        link_mode_options.pack(side=tk.LEFT, padx=5)
+
+        self.preferred_root_entry = ctk.CTkEntry(link_frame, width=300, placeholder_text="Preferred folder to keep files in")
+        self.preferred_root_entry.pack(side=tk.LEFT, padx=5)
+
         self.progress_bar_duplicates = ctk.CTkProgressBar(button_frame, mode='determinate')
         self.progress_bar_duplicates.pack(side=tk.LEFT, padx=5, fill='x', expand=True)
         self.progress_bar_duplicates.set(0)
@@ -323,6 +590,9 @@ class DataOptimizer(ctk.CTk):
         self.progress_label_duplicates = ctk.CTkLabel(button_frame, text="0%")
         self.progress_label_duplicates.pack(side=tk.LEFT, padx=5)
 
+        # Finder of the last completed duplicate scan, its hash groups are linked by link_duplicates
+        self.duplicate_finder = None
+
         terminal_frame = ctk.CTkFrame(self.remove_duplicates_tab)
         terminal_frame.pack(pady=10, padx=10, fill='both', expand=True)
 
@@ -348,6 +618,9 @@ class DataOptimizer(ctk.CTk):
         scan_button = ctk.CTkButton(button_frame, text="Scan Files", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.scan_files_by_size)
         scan_button.pack(side=tk.LEFT, padx=5)
 
+        cancel_button = ctk.CTkButton(button_frame, text="Cancel", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=lambda: self.cancel_job("sizes"))
+        cancel_button.pack(side=tk.LEFT, padx=5)
+
         self.progress_bar_files_by_size = ctk.CTkProgressBar(button_frame, mode='determinate', fg_color="#FF0000", progress_color="#CC0000", border_color="#FF0000")
         self.progress_bar_files_by_size.pack(side=tk.LEFT, padx=5, fill='x', expand=True)
         self.progress_bar_files_by_size.set(0)
@@ -358,11 +631,20 @@ class DataOptimizer(ctk.CTk):
         self.size_var = tk.StringVar(value="MB")
         size_options = ttk.Combobox(button_frame, textvariable=self.size_var, values=["Bytes", "KB", "MB", "GB"])
         size_options.pack(side=tk.LEFT, padx=5)
+        size_options.bind("<<ComboboxSelected>>", lambda _: self.files_view.refresh())
+
+        self.top_k_entry = ctk.CTkEntry(button_frame, width=80, placeholder_text=f"Top {DEFAULT_TOP_K}")
+        self.top_k_entry.pack(side=tk.LEFT, padx=5)
+
+        self.size_view_var = tk.StringVar(value="Largest Files")
+        size_view_options = ttk.Combobox(button_frame, textvariable=self.size_view_var, values=["Largest Files", "Folder Totals", "Size Histogram"], state="readonly")
+        size_view_options.pack(side=tk.LEFT, padx=5)
+        size_view_options.bind("<<ComboboxSelected>>", lambda _: self.show_size_report())
 
-        self.files_tree = ttk.Treeview(self.file_size_tab, columns=("filepath", "size"), show="headings")
-        self.files_tree.heading("filepath", text="File Path")
-        self.files_tree.heading("size", text="Size")
-        self.files_tree.pack(pady=10, padx=10, fill='both', expand=True)
+        self.size_report = None
+        self.files_view = VirtualTreeview(self.file_size_tab, columns=("filepath", "size"))
+        self.files_view.pack(pady=10, padx=10, fill='both', expand=True)
+        self.files_view.set_rows([], self.format_size_row, {"filepath": "File Path", "size": "Size"})
 
         button_option_frame = ctk.CTkFrame(self.file_size_tab)
         button_option_frame.pack(pady=10, padx=10, fill='x')
@@ -370,6 +652,10 @@ class DataOptimizer(ctk.CTk):
         compress_button = ctk.CTkButton(button_option_frame, text="Compress Files", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.compress_files)
         compress_button.pack(side=tk.LEFT, padx=5)
 
+        self.codec_var = tk.StringVar(value="deflate")
+        codec_options = ttk.Combobox(button_option_frame, textvariable=self.codec_var, values=["deflate", "bz2", "lzma", "store"], state="readonly", width=8)
+        codec_options.pack(side=tk.LEFT, padx=5)
+
         delete_button = ctk.CTkButton(button_option_frame, text="Delete Files", fg_color="#FF0000", hover_color="#CC0000", text_color="#FFFFFF", command=self.delete_files_permanently)
         delete_button.pack(side=tk.LEFT, padx=5)
 
@@ -380,17 +666,9 @@ class DataOptimizer(ctk.CTk):
             return
 
         folder_list = self.folder_list_text.get("1.0", tk.END).strip().split('\n')
-        total_folders = len(folder_list)
         self.progress_bar.set(0)
-
-        for i, folder in enumerate(folder_list):
-            folder_path = os.path.join(base_path, folder.strip())
-            os.makedirs(folder_path, exist_ok=True)
-            progress = (i + 1) / total_folders * 100
-            self.progress_bar.set(progress / 100)
-            self.progress_label.configure(text=f"{progress:.0f}%")
-            self.update_idletasks()
-            self.output_terminal.insert(tk.END, f"Created: {folder_path}\n")
+        self.start_job("create", create_folders_job, base_path, folder_list,
+                       progress_bar=self.progress_bar, progress_label=self.progress_label, terminal=self.output_terminal)
 
     def scan_duplicates(self):
         target_path = self.target_path_entry.get().strip()
@@ -403,21 +681,44 @@ class DataOptimizer(ctk.CTk):
             ctk.CTkMessageBox.show_warning(title="Warning", message="Please select at least one method to find duplicates.")
             return
 
-        duplicate_finder = DuplicateFinder()
-        duplicates = duplicate_finder.find_duplicates(target_path, methods)
-        total_files = sum(len(paths) for paths in duplicates.values())
+        workers = self.hash_workers_entry.get().strip()
+        if workers and not workers.isdigit():
+            ctk.CTkMessageBox.show_warning(title="Warning", message="The number of workers must be a whole number.")
+            return
+
+        storage = self.storage_var.get().lower()
+        engine_options = {"workers": int(workers) if workers else None, "algorithm": self.hash_algorithm_var.get()}
+        if storage == "auto":
+            engine = HashEngine.for_path(target_path, **engine_options)
+        else:
+            engine = HashEngine(storage=storage, **engine_options)
+
         self.progress_bar_duplicates.set(0)
+        self.start_job("duplicates", find_duplicates_job, target_path, methods, engine, self.size_var.get(),
+                       progress_bar=self.progress_bar_duplicates, progress_label=self.progress_label_duplicates,
+                       terminal=self.output_terminal_duplicates,
+                       on_done=lambda duplicate_finder: self.show_stage_stats(duplicate_finder, methods))
+
+    def show_stage_stats(self, duplicate_finder, methods):
+        self.duplicate_finder = duplicate_finder
+        if "hash" in methods or "tree" in methods:
+            for stage, stats in duplicate_finder.stage_stats.items():
+                self.output_terminal_duplicates.insert(tk.END, f"Stage {stage}: {stats['files']} files, {self.convert_size(stats['bytes'])} read, {stats['cached']} hashes from index\n")
+
+    def link_duplicates(self):
+        if not self.duplicate_finder or not self.duplicate_finder.hashed_rows:
+            ctk.CTkMessageBox.show_warning(title="Warning", message="Please find duplicates with the hash method first.")
+            return
 
-        progress_count = 0
-        for file_key, paths in duplicates.items():
-            self.output_terminal_duplicates.insert(tk.END, f"Duplicates for {file_key}:\n")
-            for path in paths:
-                self.output_terminal_duplicates.insert(tk.END, f"  {path}\n")
-                progress_count += 1
-                progress = (progress_count / total_files) * 100
-                self.progress_bar_duplicates.set(progress / 100)
-                self.progress_label_duplicates.configure(text=f"{progress:.0f}%")
-                self.update_idletasks()
+        if not messagebox.askyesno("Replace Duplicates", "Replace the duplicates found by hash with links to one kept copy each?"):
+            return
+
+        policy = "shortest" if self.keep_policy_var.get() == "Shortest Path" else "oldest"
+        preferred_root = self.preferred_root_entry.get().strip() or None
+        self.progress_bar_duplicates.set(0)
+        self.start_job("duplicates", link_duplicates_job, self.duplicate_finder, policy, preferred_root, self.link_mode_var.get().lower(), self.size_var.get(),
+                       progress_bar=self.progress_bar_duplicates, progress_label=self.progress_label_duplicates,
+                       terminal=self.output_terminal_duplicates)
 
     def scan_files_by_size(self):
         target_path = self.size_scan_path_entry.get().strip()
@@ -425,58 +726,66 @@ class DataOptimizer(ctk.CTk):
             ctk.CTkMessageBox.show_warning(title="Warning", message="Please specify a target path.")
             return
 
-        self.files_tree.delete(*self.files_tree.get_children())
-        files_with_sizes = []
-        file_count = 0
-        for root, _, files in os.walk(target_path):
-            file_count += len(files)
-            
-        progress_count = 0
-        for root, _, files in os.walk(target_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                try:
-                    size = os.path.getsize(file_path)
-                    files_with_sizes.append((file_path, size))
-                except OSError as e:
-                    print(f"Error retrieving file size: {e}")
-
-                progress_count += 1
-                progress = (progress_count / file_count) * 100
-                self.progress_bar_files_by_size.set(progress / 100)
-                self.progress_label_files_by_size.configure(text=f"{progress:.0f}%")
-                self.update_idletasks()
-
-        for file_path, size in sorted(files_with_sizes, key=lambda x: x[1], reverse=True):
-            display_size = self.convert_size(size)
-            self.files_tree.insert("", "end", values=(file_path, display_size))
+        top_k = self.top_k_entry.get().strip()
+        if top_k and not top_k.isdigit():
+            ctk.CTkMessageBox.show_warning(title="Warning", message="The number of files to show must be a whole number.")
+            return
 
-    def convert_size(self, size):
-        size_unit = self.size_var.get()
-        if size_unit == "KB":
-            return f"{size / 1024:.2f} KB"
-        elif size_unit == "MB":
-            return f"{size / (1024 * 1024):.2f} MB"
-        elif size_unit == "GB":
-            return f"{size / (1024 * 1024 * 1024):.2f} GB"
+        self.size_report = None
+        self.show_size_report()
+        self.progress_bar_files_by_size.set(0)
+        self.start_job("sizes", scan_files_by_size_job, target_path, int(top_k) if top_k else DEFAULT_TOP_K,
+                       progress_bar=self.progress_bar_files_by_size, progress_label=self.progress_label_files_by_size,
+                       on_done=self.show_size_report)
+
+    # Show the selected view of the last size report
+    def show_size_report(self, report=None):
+        if report:
+            self.size_report = report
+        view = self.size_view_var.get()
+        if not self.size_report:
+            self.files_view.set_rows([], self.format_size_row, {"filepath": "File Path", "size": "Size"})
+        elif view == "Folder Totals":
+            self.files_view.set_rows(self.size_report.directory_totals(), self.format_size_row, {"filepath": "Folder", "size": "Total Size"})
+        elif view == "Size Histogram":
+            self.files_view.set_rows(self.size_report.histogram(), self.format_histogram_row, {"filepath": "Size Range", "size": "Files"})
         else:
-            return f"{size} Bytes"
+            self.files_view.set_rows(self.size_report.largest_files(), self.format_size_row, {"filepath": "File Path", "size": "Size"})
+
+    def format_size_row(self, row):
+        path, size = row
+        return path, self.convert_size(size)
+
+    def format_histogram_row(self, row):
+        low, high, file_count, total_size = row
+        return f"{self.convert_size(low)} - {self.convert_size(high)}", f"{file_count} files, {self.convert_size(total_size)}"
+
+    # Paths of the files selected in the largest files view
+    def selected_files(self):
+        if not self.size_report or self.size_view_var.get() != "Largest Files":
+            return []
+        return [path for path, _ in self.files_view.selected_rows()]
+
+    def convert_size(self, size):
+        return format_size(size, self.size_var.get())
 
     def compress_files(self):
-        selected_files = [self.files_tree.item(item)['values'][0] for item in self.files_tree.selection()]
+        selected_files = self.selected_files()
         if not selected_files:
             ctk.CTkMessageBox.show_warning(title="Warning", message="Please select files to compress.")
             return
 
-        zip_filename = "compressed_files.zip"
-        with zipfile.ZipFile(zip_filename, 'w') as zipf:
-            for file in selected_files:
-                zipf.write(file, os.path.basename(file))
+        zip_filename = asksaveasfilename(defaultextension=".zip", initialfile="compressed_files.zip", filetypes=[("ZIP archives", "*.zip")])
+        if not zip_filename:
+            return
 
-        ctk.CTkMessageBox.show_info(title="Info", message=f"Successfully compressed to {zip_filename}.")
+        self.progress_bar_files_by_size.set(0)
+        self.start_job("sizes", compress_files_job, selected_files, zip_filename, self.size_report.root, self.codec_var.get(),
+                       progress_bar=self.progress_bar_files_by_size, progress_label=self.progress_label_files_by_size,
+                       on_done=lambda _: ctk.CTkMessageBox.show_info(title="Info", message=f"Successfully compressed to {zip_filename}."))
 
     def delete_files_permanently(self):
-        selected_files = [self.files_tree.item(item)['values'][0] for item in self.files_tree.selection()]
+        selected_files = self.selected_files()
         if not selected_files:
             ctk.CTkMessageBox.show_warning(title="Warning", message="Please select files to delete.")
             return